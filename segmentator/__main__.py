@@ -8,6 +8,7 @@ Use config.py to hold arguments to be accessed by imported scripts.
 """
 
 from __future__ import print_function
+import glob
 import argparse
 import segmentator.config as cfg
 from segmentator import __version__
@@ -20,8 +21,9 @@ def main():
 
     # Add arguments to namespace:
     parser.add_argument(
-        'filename', metavar='path',
-        help="Path to input. Mostly a nifti file with image data."
+        'filename', metavar='path', nargs='+',
+        help="Path to input. Mostly a nifti file with image data. Several \
+        paths or glob patterns can be given with --nogui."
         )
     parser.add_argument(
         "--gramag", metavar=str(cfg.gramag), required=False,
@@ -53,6 +55,12 @@ def main():
         default=cfg.perc_max,
         help="Maximum percentile used in truncation."
         )
+    parser.add_argument(
+        "--approx_percentiles", action='store_true',
+        help="Use approximate percentiles in truncation, computed from a fine \
+        histogram that is filled slab by slab. The rank error is reported. \
+        Useful for very large images. Off by default."
+        )
     parser.add_argument(
         "--valmin", metavar=str(cfg.valmin), required=False, type=float,
         default=cfg.valmin,
@@ -82,6 +90,17 @@ def main():
         "--nogui", action='store_true',
         help="Only save 2D histogram image without showing GUI."
         )
+    parser.add_argument(
+        "--nr_processes", metavar='0', required=False, type=int, default=0,
+        help="Number of images processed in parallel with --nogui. 0 uses \
+        all available cores."
+        )
+    parser.add_argument(
+        "--group_name", metavar='path', required=False, default=None,
+        help="Path prefix of the group sum, mean and log-mean histograms \
+        saved with --nogui for several images. 'group' in the common \
+        directory of the inputs by default."
+        )
     parser.add_argument(
         "--include_zeros", action='store_true',
         help="Include image zeros in histograms. Not used by default."
@@ -95,6 +114,27 @@ def main():
         help="Do not change the data type of the input image. Can be useful \
         for very large images. Off by default."
         )
+    parser.add_argument(
+        "--nr_workers", metavar=str(cfg.nr_workers), required=False,
+        type=int, default=cfg.nr_workers,
+        help="Number of threads used in gradient magnitude computation. \
+        0 uses all available cores."
+        )
+    parser.add_argument(
+        "--no_cache", action='store_true',
+        help="Do not read or write cached gradient magnitude images."
+        )
+    parser.add_argument(
+        "--cache_dir", metavar=str(cfg.cache_dir), required=False,
+        default=cfg.cache_dir,
+        help="Directory of cached gradient magnitude images."
+        )
+    parser.add_argument(
+        "--cache_size", metavar=str(cfg.cache_size), required=False,
+        type=float, default=cfg.cache_size,
+        help="Maximum size of the cache in gigabytes. Least recently used \
+        files are removed first."
+        )
     parser.add_argument(
         "--matplotlib_backend", metavar=str(cfg.matplotlib_backend),
         default=cfg.matplotlib_backend, required=False,
@@ -135,13 +175,19 @@ def main():
 
     # set cfg file variables to be accessed from other scripts
     args = parser.parse_args()
+    filenames = []
+    for pattern in args.filename:  # expand patterns, e.g. on windows
+        filenames += sorted(glob.glob(pattern)) or [pattern]
+    if len(filenames) > 1 and not args.nogui:
+        parser.error('Several inputs can only be used with --nogui.')
     # used in all
-    cfg.filename = args.filename
+    cfg.filename = filenames[0]
     # used in segmentator GUI (main and ncut)
     cfg.gramag = args.gramag
     cfg.scale = args.scale
     cfg.perc_min = args.percmin
     cfg.perc_max = args.percmax
+    cfg.approx_percentiles = args.approx_percentiles
     cfg.valmin = args.valmin
     cfg.valmax = args.valmax
     cfg.cbar_max = args.cbar_max
@@ -150,6 +196,11 @@ def main():
         cfg.discard_zeros = False
     cfg.export_gramag = args.export_gramag
     cfg.force_original_precision = args.force_original_precision
+    cfg.nr_workers = args.nr_workers
+    if args.no_cache:
+        cfg.use_cache = False
+    cfg.cache_dir = args.cache_dir
+    cfg.cache_size = args.cache_size
     cfg.matplotlib_backend = args.matplotlib_backend
     # used in ncut preparation
     cfg.ncut_figs = args.ncut_figs
@@ -168,7 +219,9 @@ def main():
     # Call other scripts with import method (couldn't find a better way).
     if args.nogui:
         print('No GUI option is selected. Saving 2D histogram image...')
-        import segmentator.hist2d_counts
+        from segmentator.hist2d_counts import main as save_hist2d_counts
+        save_hist2d_counts(filenames, nr_processes=args.nr_processes,
+                           group_name=args.group_name)
     elif args.ncut_prepare:
         print('Preparing N-cut file...')
         import segmentator.ncut_prepare
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Apply a volume histogram selection to many images without the GUI."""
+
+from __future__ import division, print_function
+import os
+import copy
+import time
+import numpy as np
+from multiprocessing import Pool, cpu_count
+from segmentator.pipeline import pipeline_params, preprocess
+from segmentator.pipeline import map_selection, export_labels
+
+
+def output_filename(filename, out_dir=None, suffix='labels'):
+    """Path of the label volume of an input image.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the input image.
+    out_dir : str, optional
+        Output directory. Next to the input if not given.
+    suffix : str
+        Added to the input name.
+
+    Returns
+    -------
+    outName : str
+
+    """
+    basename = os.path.basename(filename).split(os.extsep, 1)[0]
+    if out_dir is None:
+        out_dir = os.path.dirname(filename)
+    return os.path.join(out_dir, '{}_{}.nii.gz'.format(basename, suffix))
+
+
+def apply_selection(filename, volHistMask, params=None, out_dir=None,
+                    write_cache=False):
+    """Preprocess one image, map the selection and save the labels.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a nifti file.
+    volHistMask : np.ndarray, shape(nr_bins, nr_bins)
+        Volume histogram mask or labels.
+    params : pipeline_params, optional
+        Pipeline parameters. Defaults are taken from segmentator.config.
+    out_dir : str, optional
+        Output directory. Next to the input if not given.
+    write_cache : bool
+        Store the preprocessed arrays in the cache (see pipeline.preprocess).
+        Off by default, arrays of images that are processed once would only
+        evict other cache entries. Cached arrays are read either way.
+
+    Returns
+    -------
+    summary : dict
+        Input and output paths, duration in seconds, number of labelled
+        voxels and number of voxels per label. 'error' holds the message
+        if the image could not be processed.
+
+    """
+    params = pipeline_params() if params is None else params
+    summary = dict(input=filename, output='', seconds=0., voxels=0,
+                   label_counts=[], error='')
+    start = time.time()
+    try:
+        volume = preprocess(filename, params, write_cache=write_cache)
+        if volHistMask.shape != (volume.nr_bins, volume.nr_bins):
+            raise ValueError(
+                'Selection has {} bins, image has {} (see --scale).'.format(
+                    volHistMask.shape[0], volume.nr_bins))
+        labels = map_selection(volume, volHistMask, params.discard_zeros)
+        summary['output'] = output_filename(filename, out_dir)
+        export_labels(volume, labels, summary['output'])
+        label_counts = np.bincount(labels.ravel())
+        summary['voxels'] = int(label_counts[1:].sum())
+        summary['label_counts'] = label_counts[1:].tolist()
+    except Exception as error:  # report and continue with other images
+        summary['error'] = '{}: {}'.format(type(error).__name__, error)
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def apply_selection_task(task):
+    """Unpack arguments of apply_selection (used in process pool)."""
+    return apply_selection(*task)
+
+
+def run_batch(filenames, volHistMask, params=None, out_dir=None,
+              nr_processes=0, max_tasks_per_process=8, write_cache=False):
+    """Apply a selection to many images in parallel.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Paths to nifti files.
+    volHistMask : np.ndarray, shape(nr_bins, nr_bins)
+        Volume histogram mask or labels.
+    params : pipeline_params, optional
+        Pipeline parameters. Defaults are taken from segmentator.config.
+    out_dir : str, optional
+        Output directory. Next to the inputs if not given.
+    nr_processes : int
+        Number of worker processes, 0 uses all available cores. Each process
+        holds one image at a time.
+    max_tasks_per_process : int
+        Worker processes are replaced after this many images, which returns
+        their memory to the operating system.
+    write_cache : bool
+        Store the preprocessed arrays of every image in the cache, see
+        apply_selection.
+
+    Yields
+    ------
+    summary : dict
+        Summary of each image (see apply_selection), in order of completion.
+
+    """
+    params = pipeline_params() if params is None else copy.copy(params)
+    if nr_processes < 1:
+        nr_processes = cpu_count()
+    nr_processes = max(1, min(nr_processes, len(filenames)))
+    if params.nr_workers < 1:
+        # share the cores between processes instead of oversubscribing
+        params.nr_workers = max(1, cpu_count() // nr_processes)
+    if out_dir is not None and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    tasks = [(filename, volHistMask, params, out_dir, write_cache)
+             for filename in filenames]
+    if nr_processes == 1:
+        for task in tasks:
+            yield apply_selection_task(task)
+        return
+    pool = Pool(nr_processes, maxtasksperchild=max_tasks_per_process)
+    try:
+        for summary in pool.imap_unordered(apply_selection_task, tasks):
+            yield summary
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def write_summary(summaries, filename, nr_labels):
+    """Write per image summaries as a tab separated table.
+
+    Parameters
+    ----------
+    summaries : list of dict
+        Outputs of apply_selection.
+    filename : str
+        Path of the table.
+    nr_labels : int
+        Number of labels in the selection, one column each.
+
+    """
+    header = ['input', 'output', 'seconds', 'voxels']
+    header += ['label_{}'.format(i + 1) for i in range(nr_labels)]
+    header += ['error']
+    with open(filename, 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for summary in summaries:
+            counts = list(summary['label_counts'])
+            counts += [0] * (nr_labels - len(counts))
+            row = [summary['input'], summary['output'],
+                   '{:.3f}'.format(summary['seconds']),
+                   str(summary['voxels'])]
+            row += [str(c) for c in counts] + [summary['error']]
+            f.write('\t'.join(row) + '\n')
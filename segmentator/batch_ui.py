@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""Entry point of batch processing.
+
+Applies a saved volume histogram selection to many images.
+"""
+
+from __future__ import print_function
+import os
+import time
+import argparse
+import segmentator.config as cfg
+from segmentator import __version__
+from segmentator.utils import relabel_2D_hist_mask
+from segmentator.pipeline import pipeline_params
+from segmentator.selection import load_selection, use_selection_params
+from segmentator.batch import run_batch, write_summary
+
+
+def main():
+    """Command line call argument parsing."""
+    # Instantiate argument parser object:
+    parser = argparse.ArgumentParser()
+
+    # Add arguments to namespace:
+    parser.add_argument(
+        'filenames', metavar='path', nargs='+',
+        help="Paths to inputs. Nifti files with image data."
+        )
+    parser.add_argument(
+        "--selection", metavar='path', required=True,
+        help="Path to a selection file (*_selection_*.npz) saved with \
+        'Export Hist' in the GUI, or to a numpy file with ncut labels \
+        (*_volHistLabels_*.npy). The *_volHist_*.npy of the main GUI holds \
+        histogram counts and is not a selection. Preprocessing parameters \
+        stored in a selection file are used instead of the command line ones."
+        )
+    parser.add_argument(
+        "--out_dir", metavar='path', required=False, default=None,
+        help="Directory of the label volumes. Next to the inputs by default."
+        )
+    parser.add_argument(
+        "--summary", metavar='path', required=False, default=None,
+        help="Path of the summary table (tab separated). \
+        'segmentator_batch_summary.tsv' in the output directory by default."
+        )
+    parser.add_argument(
+        "--nr_processes", metavar='0', required=False, type=int, default=0,
+        help="Number of images processed in parallel. 0 uses all available \
+        cores."
+        )
+    parser.add_argument(
+        "--gramag", metavar=str(cfg.gramag), required=False, default=None,
+        help="'scharr', 'deriche', 'sobel', 'prewitt' or 'numpy'. Required \
+        if the selection was made with a gradient magnitude image, which is \
+        not applied to other images."
+        )
+    parser.add_argument(
+        "--deriche_alpha", required=False, type=float,
+        default=cfg.deriche_alpha, metavar=cfg.deriche_alpha,
+        help="Used only in Deriche gradient magnitude option."
+        )
+    parser.add_argument(
+        "--scale", metavar=str(cfg.scale), required=False, type=float,
+        default=cfg.scale,
+        help="Determines nr of bins. Has to match the selection."
+        )
+    parser.add_argument(
+        "--percmin", metavar=str(cfg.perc_min), required=False, type=float,
+        default=cfg.perc_min,
+        help="Minimum percentile used in truncation."
+        )
+    parser.add_argument(
+        "--percmax",  metavar=str(cfg.perc_max), required=False,  type=float,
+        default=cfg.perc_max,
+        help="Maximum percentile used in truncation."
+        )
+    parser.add_argument(
+        "--approx_percentiles", action='store_true',
+        help="Use approximate percentiles in truncation."
+        )
+    parser.add_argument(
+        "--valmin", metavar=str(cfg.valmin), required=False, type=float,
+        default=cfg.valmin,
+        help="Minimum value, overwrites percentile."
+        )
+    parser.add_argument(
+        "--valmax",  metavar=str(cfg.valmax), required=False,  type=float,
+        default=cfg.valmax,
+        help="Maximum value, overwrites percentile."
+        )
+    parser.add_argument(
+        "--include_zeros", action='store_true',
+        help="Include image zeros in histograms. Not used by default."
+        )
+    parser.add_argument(
+        "--force_original_precision", action='store_true',
+        help="Do not change the data type of the input images."
+        )
+    parser.add_argument(
+        "--nr_workers", metavar=str(cfg.nr_workers), required=False,
+        type=int, default=cfg.nr_workers,
+        help="Number of threads per process used in gradient magnitude \
+        computation. 0 shares the available cores between processes."
+        )
+    parser.add_argument(
+        "--no_cache", action='store_true',
+        help="Do not read cached preprocessed images. Batch runs never \
+        write them, every image would evict the previous one."
+        )
+    parser.add_argument(
+        "--cache_dir", metavar=str(cfg.cache_dir), required=False,
+        default=cfg.cache_dir,
+        help="Directory of cached preprocessed images."
+        )
+    parser.add_argument(
+        "--cache_size", metavar=str(cfg.cache_size), required=False,
+        type=float, default=cfg.cache_size,
+        help="Maximum size of the cache in gigabytes."
+        )
+
+    args = parser.parse_args()
+    params = pipeline_params(
+        gramag=args.gramag or cfg.gramag, deriche_alpha=args.deriche_alpha,
+        scale=args.scale, perc_min=args.percmin, perc_max=args.percmax,
+        approx_percentiles=args.approx_percentiles, valmin=args.valmin,
+        valmax=args.valmax, discard_zeros=not args.include_zeros,
+        force_original_precision=args.force_original_precision,
+        nr_workers=args.nr_workers, use_cache=not args.no_cache,
+        cache_dir=args.cache_dir, cache_size=args.cache_size)
+
+    welcome_str = 'Segmentator {}'.format(__version__)
+    welcome_decor = '=' * len(welcome_str)
+    print('{}\n{}\n{}'.format(welcome_decor, welcome_str, welcome_decor))
+    print('Batch processing of {} images...'.format(len(args.filenames)))
+
+    volHistMask, info = load_selection(args.selection)
+    if info['params'] is not None:
+        print('Using preprocessing parameters of the selection.')
+        try:
+            use_selection_params(params, info['params'], gramag=args.gramag)
+        except ValueError as error:
+            parser.error(str(error))
+    nr_labels = int(relabel_2D_hist_mask(volHistMask,
+                                         params.discard_zeros).max())
+    summary_name = args.summary
+    if summary_name is None:
+        summary_name = os.path.join(args.out_dir or os.curdir,
+                                    'segmentator_batch_summary.tsv')
+
+    start = time.time()
+    summaries = []
+    for summary in run_batch(args.filenames, volHistMask, params,
+                             out_dir=args.out_dir,
+                             nr_processes=args.nr_processes):
+        if summary['error']:
+            print('  {} failed: {}'.format(summary['input'],
+                                           summary['error']))
+        else:
+            print('  {} done in {:.1f} seconds.'.format(summary['input'],
+                                                        summary['seconds']))
+        summaries.append(summary)
+    summaries.sort(key=lambda summary: summary['input'])
+    write_summary(summaries, summary_name, nr_labels)
+    print('Finished in {:.1f} seconds, summary saved as:\n {}'.format(
+        time.time() - start, summary_name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+"""Content-addressed on-disk cache for derived images."""
+
+from __future__ import division, print_function
+import os
+import json
+import hashlib
+import numpy as np
+import segmentator.config as cfg
+
+# Increase when the way cached arrays are computed changes
+CACHE_VERSION = 1
+
+# Preprocessed arrays that are needed to start the GUI. 'limits' holds
+# pMin, pMax, d_min, d_max, nr_bins and the minimum and maximum of the
+# scaled image.
+SESSION_ARRAYS = ['orig', 'ima2volHistMap', 'counts', 'bin_edges',
+                  'binVoxels', 'binOffsets', 'limits']
+
+
+def file_hash(filename, cache_dir=None, block_size=2**20):
+    """Compute sha1 hash of file content.
+
+    Hashes are memoized in the cache directory, keyed on absolute path,
+    size and modification time, so unchanged files are only read once.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the file.
+    cache_dir : str, optional
+        Directory of the memoized hashes. Not memoized if not given.
+    block_size : int
+        Number of bytes read at once.
+
+    Returns
+    -------
+    digest : str
+        Hexadecimal sha1 digest.
+
+    """
+    filename = os.path.abspath(filename)
+    info = os.stat(filename)
+    signature = [info.st_size, info.st_mtime_ns]
+    index_path, index = None, {}
+    if cache_dir is not None:
+        index_path = os.path.join(cache_dir, 'file_hashes.json')
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            index = {}
+        if filename in index and index[filename][:2] == signature:
+            return index[filename][2]
+
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    digest = sha1.hexdigest()
+
+    if index_path is not None:
+        index[filename] = signature + [digest]
+        try:
+            atomic_write(index_path, lambda f: f.write(
+                json.dumps(index).encode('utf-8')))
+        except (IOError, OSError):
+            pass
+    return digest
+
+
+def cache_key(*parts, **params):
+    """Combine strings and parameters into one cache key.
+
+    Parameters
+    ----------
+    parts : str
+        For example file hashes or other cache keys.
+    params : dict
+        Parameters that change the cached result. Have to be JSON
+        serializable.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal sha1 digest.
+
+    """
+    content = json.dumps([CACHE_VERSION, parts, params], sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def preprocessing_params(params=None, **overrides):
+    """Collect parameters of truncation and scaling.
+
+    Parameters
+    ----------
+    params : pipeline_params, optional
+        Parameter object. Uses segmentator.config if not given.
+    overrides : dict
+        Parameters to add or replace, e.g. value range truncation.
+
+    Returns
+    -------
+    prep_params : dict
+
+    """
+    params = cfg if params is None else params
+    prep_params = dict(
+        perc_min=params.perc_min, perc_max=params.perc_max,
+        approx_percentiles=params.approx_percentiles, scale=params.scale,
+        force_original_precision=params.force_original_precision)
+    prep_params.update(overrides)
+    return prep_params
+
+
+def preprocessing_key(filename, prep_params, params=None):
+    """Cache key of a preprocessed input file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the input image.
+    prep_params : dict
+        Preprocessing parameters (see `preprocessing_params`).
+    params : pipeline_params, optional
+        Parameter object with the cache settings. Uses segmentator.config if
+        not given.
+
+    Returns
+    -------
+    key : str or None
+        None if caching is disabled.
+
+    """
+    cache = get_cache(params)
+    if cache is None:
+        return None
+    return cache_key(file_hash(filename, cache_dir=cache.cache_dir),
+                     **prep_params)
+
+
+def gradient_key(key, gramag_option, params=None):
+    """Cache key of the gradient magnitude of a preprocessed image.
+
+    Parameters
+    ----------
+    key : str or None
+        Cache key of the preprocessed image.
+    gramag_option : string
+        A keyword string or a path to a nifti file.
+    params : pipeline_params, optional
+        Parameter object. Uses segmentator.config if not given.
+
+    Returns
+    -------
+    key : str or None
+
+    """
+    params = cfg if params is None else params
+    if key is None:
+        return None
+    if gramag_option not in params.gramag_options:
+        return cache_key(key, file_hash(gramag_option, params.cache_dir),
+                         gramag='file')
+    elif gramag_option == 'deriche':
+        return cache_key(key, gramag=gramag_option,
+                         deriche_alpha=params.deriche_alpha)
+    return cache_key(key, gramag=gramag_option)
+
+
+def session_key(key, gramag_option, params=None):
+    """Cache key of the preprocessed state of a GUI session.
+
+    Parameters
+    ----------
+    key : str or None
+        Cache key of the preprocessed image.
+    gramag_option : string
+        A keyword string or a path to a nifti file.
+    params : pipeline_params, optional
+        Parameter object. Uses segmentator.config if not given.
+
+    Returns
+    -------
+    key : str or None
+
+    """
+    params = cfg if params is None else params
+    key = gradient_key(key, gramag_option, params)
+    if key is None:
+        return None
+    return cache_key(key, session=SESSION_ARRAYS,
+                     discard_zeros=params.discard_zeros)
+
+
+def load_session(key, params=None):
+    """Memory-map the cached arrays of a GUI session.
+
+    Parameters
+    ----------
+    key : str or None
+        Session key (see `session_key`).
+    params : pipeline_params, optional
+        Parameter object with the cache settings. Uses segmentator.config if
+        not given.
+
+    Returns
+    -------
+    session : dict or None
+        Read only arrays named as in SESSION_ARRAYS. None if any of them is
+        not in cache.
+
+    """
+    cache = get_cache(params) if key is not None else None
+    if cache is None:
+        return None
+    session = {}
+    for name in SESSION_ARRAYS:
+        data = cache.load(cache_key(key, array=name))
+        if data is None:
+            return None
+        session[name] = data
+    return session
+
+
+def save_session(key, params=None, **arrays):
+    """Store the arrays of a GUI session.
+
+    Parameters
+    ----------
+    key : str or None
+        Session key (see `session_key`).
+    params : pipeline_params, optional
+        Parameter object with the cache settings. Uses segmentator.config if
+        not given.
+    arrays : dict
+        Arrays named as in SESSION_ARRAYS.
+
+    """
+    cache = get_cache(params) if key is not None else None
+    if cache is None:
+        return
+    for name in SESSION_ARRAYS:
+        cache.save(cache_key(key, array=name), np.asarray(arrays[name]))
+
+
+class array_cache:
+    """Directory of .npy files with size bounded LRU eviction."""
+
+    def __init__(self, cache_dir, max_size):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory of the cached files, created if missing.
+        max_size : int
+            Maximum total size of cached arrays in bytes.
+
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, key):
+        """Path of a cached array."""
+        return os.path.join(self.cache_dir, '{}.npy'.format(key))
+
+    def load(self, key):
+        """Memory-map a cached array.
+
+        Parameters
+        ----------
+        key : str
+            Cache key.
+
+        Returns
+        -------
+        data : np.memmap or None
+            Read only array, None if not in cache.
+
+        """
+        path = self.path(key)
+        try:
+            data = np.load(path, mmap_mode='r')
+            os.utime(path, None)  # mark as recently used
+        except (IOError, OSError, ValueError):
+            return None
+        return data
+
+    def save(self, key, data):
+        """Store an array and evict least recently used arrays.
+
+        Parameters
+        ----------
+        key : str
+            Cache key.
+        data : np.ndarray
+            Array to store.
+
+        """
+        if data.nbytes > self.max_size:
+            return
+        try:
+            atomic_write(self.path(key), lambda f: np.save(f, data))
+        except (IOError, OSError) as error:
+            print('  Could not write to cache: {}'.format(error))
+            return
+        self.evict(keep=self.path(key))
+
+    def evict(self, keep=None):
+        """Remove least recently used arrays until below maximum size.
+
+        Parameters
+        ----------
+        keep : str, optional
+            Path of a file that is not removed.
+
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:  # e.g. still memory-mapped on windows
+                pass
+
+
+def get_cache(params=None):
+    """Return the configured cache, None if caching is disabled.
+
+    Parameters
+    ----------
+    params : pipeline_params, optional
+        Parameter object with the cache settings. Uses segmentator.config if
+        not given.
+
+    Returns
+    -------
+    cache : array_cache or None
+
+    """
+    params = cfg if params is None else params
+    if not params.use_cache:
+        return None
+    try:
+        return array_cache(params.cache_dir, int(params.cache_size * 2**30))
+    except (IOError, OSError) as error:
+        print('  Cache is disabled: {}'.format(error))
+        return None
+
+
+def atomic_write(path, write):
+    """Write to a temporary file and move it in place."""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
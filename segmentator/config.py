@@ -4,6 +4,8 @@ Useful to hold command line arguments.
 
 """
 
+import os
+
 # Define variables used to initialise the sector mask
 init_centre = (0, 0)
 init_radius = 100
@@ -15,6 +17,7 @@ gramag = 'scharr'
 deriche_alpha = 3.0
 perc_min = 2.5
 perc_max = 97.5
+approx_percentiles = False
 valmin = float('nan')
 valmax = float('nan')
 scale = 400
@@ -23,6 +26,15 @@ cbar_init = 3.0
 discard_zeros = True
 export_gramag = False
 force_original_precision = False
+nr_workers = 0  # 0 uses all available cores
+
+# On-disk cache of preprocessed images
+use_cache = True
+cache_dir = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join('~', '.cache')),
+    'segmentator')
+cache_dir = os.path.expanduser(cache_dir)
+cache_size = 10.0  # in gigabytes
 
 # Change in case of glitches in the host operating system
 matplotlib_backend = 'tkagg'
@@ -1,77 +1,188 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
 """3D Deriche filter implementation."""
 
+import os
 import numpy as np
-cimport numpy as np
-
-DTYPE = np.int
-ctypedef np.int_t DTYPE_t
-
-def deriche_3D(np.ndarray[float, mode="c", ndim=3] inputData, float alpha=1):
-    """Reference: Monga et al. 1991."""
-    # c definitions
-    cdef float s, a_0, a_1, a_2, a_3 , b_1, b_2
-    cdef np.ndarray[double, mode="c", ndim=3] S_p, S_n, R_p, R_n, T_p, T_n
-    cdef np.ndarray[double, mode="c", ndim=3] S, R, P
-    cdef int imax = inputData.shape[0]
-    cdef int jmax = inputData.shape[1]
-    cdef int kmax = inputData.shape[2]
-    cdef int i, j, k
-
-    # constants
-    s = np.power((1 - np.exp(-alpha)), 2) / \
-        (1 + 2 * alpha * np.exp(-alpha) - np.exp(-2*alpha))
-    a_0 = s
-    a_1 = s * (alpha - 1) * np.exp(-alpha)
-    b_1 = -2 * np.exp(-alpha)
-    b_2 = np.exp(-2 * alpha)
-    a_2 = a_1 - s * b_1
-    a_3 = -s * b_2
-
-    # Recursive filter implementation
-    S_p = np.zeros((imax, jmax, kmax))
-    S_n = np.zeros((imax, jmax, kmax))
-    for k in range(kmax):
-        for j in range(jmax):
-            for i in range(0, imax):
-                if i > 2:
-                    S_p[i, j, k] = inputData[i-1, j, k] \
-                                   - b_1*S_p[i-1, j, k] \
-                                   - b_2*S_p[i-2, j, k]
-                i = i*-1 % inputData.shape[0]  # inverse index
-                if i < inputData.shape[0]-2:
-                    S_n[i, j, k] = inputData[i+1, j, k] \
-                                   - b_1*S_n[i+1, j, k] \
-                                   - b_2*S_n[i+2, j, k]
-
-    S = alpha*(S_p - S_n)
-
-    R_p = np.zeros((imax, jmax, kmax))
-    R_n = np.zeros((imax, jmax, kmax))
-    for k in range(kmax):
-        for i in range(imax):
-            for j in range(0, jmax):
-                if j > 2:
-                    R_p[i, j, k] = a_0*S[i, j, k] + a_1*S[i, j-1, k] \
-                                   - b_1*R_p[i, j-1, k] - b_2*R_p[i, j-2, k]
-                j = j*-1 % inputData.shape[1]  # inverse index
-                if j < inputData.shape[1]-2:
-                    R_n[i, j, k] = a_2*S[i, j+1, k] + a_3*S[i, j+2, k] \
-                                   - b_1*R_n[i, j+1, k] - b_2*R_n[i, j+2, k]
-
-    R = R_n + R_p
-
-    T_p = np.zeros((imax, jmax, kmax))
-    T_n = np.zeros((imax, jmax, kmax))
-    for i in range(imax):
-        for j in range(jmax):
-            for k in range(0, kmax):
-                if k > 2:
-                    T_p[i, j, k] = a_0*R[i, j, k] + a_1*R[i, j, k-1] \
-                                 - b_1*T_p[i, j, k-1] - b_2*T_p[i, j, k-2]
-                k = k*-1 % inputData.shape[2]  # inverse index
-                if k < inputData.shape[2]-2:
-                    T_n[i, j, k] = a_2*R[i, j, k+1] + a_3*R[i, j, k+2] \
-                                   - b_1*T_n[i, j, k+1] - b_2*T_n[i, j, k+2]
-
-    T = T_n + T_p
-    return T
+from cython.parallel import prange, parallel
+from libc.math cimport exp
+from libc.stdlib cimport malloc, free
+
+# what a filter pass does with each line
+cdef enum:
+    DERIVATIVE = 0
+    SMOOTHING = 1
+    SMOOTHING_ADD_SQUARE = 2
+
+
+cdef void derivative_line(const float *x, Py_ssize_t x_step, float *y,
+                          Py_ssize_t y_step, Py_ssize_t n, float *buf,
+                          const double *c) noexcept nogil:
+    """Recursive derivative of one line (x and y can be the same line)."""
+    cdef float *line = buf
+    cdef float *p = buf + n
+    cdef float *m = buf + 2*n
+    cdef Py_ssize_t i
+    for i in range(n):
+        line[i] = x[i*x_step]
+        p[i] = 0
+        m[i] = 0
+    # causal part
+    for i in range(3, n):
+        p[i] = line[i-1] - c[4]*p[i-1] - c[5]*p[i-2]
+    # anti-causal part
+    for i in range(n-3, -1, -1):
+        m[i] = line[i+1] - c[4]*m[i+1] - c[5]*m[i+2]
+    for i in range(n):
+        y[i*y_step] = c[6]*(p[i] - m[i])
+
+
+cdef void smoothing_line(const float *x, Py_ssize_t x_step, float *y,
+                         Py_ssize_t y_step, Py_ssize_t n, float *buf,
+                         const double *c, bint add_square) noexcept nogil:
+    """Recursive smoothing of one line (x and y can be the same line)."""
+    cdef float *line = buf
+    cdef float *p = buf + n
+    cdef float *m = buf + 2*n
+    cdef Py_ssize_t i
+    for i in range(n):
+        line[i] = x[i*x_step]
+        p[i] = 0
+        m[i] = 0
+    # causal part
+    for i in range(3, n):
+        p[i] = c[0]*line[i] + c[1]*line[i-1] - c[4]*p[i-1] - c[5]*p[i-2]
+    # anti-causal part
+    for i in range(n-3, -1, -1):
+        m[i] = c[2]*line[i+1] + c[3]*line[i+2] - c[4]*m[i+1] - c[5]*m[i+2]
+    if add_square:
+        for i in range(n):
+            y[i*y_step] += (p[i] + m[i])**2
+    else:
+        for i in range(n):
+            y[i*y_step] = p[i] + m[i]
+
+
+cdef int filter_pass(const float *x, float *y, const Py_ssize_t *shape,
+                     int axis, int mode, const double *c,
+                     int nr_threads) except -1 nogil:
+    """Filter all lines along one axis of C-contiguous volumes."""
+    cdef Py_ssize_t strides[3]
+    cdef Py_ssize_t n = shape[axis], line, offset
+    # the two other axes index the lines
+    cdef int b = 1 if axis == 0 else 0
+    cdef int d = 1 if axis == 2 else 2
+    cdef float *buf = NULL
+    strides[0] = shape[1] * shape[2]
+    strides[1] = shape[2]
+    strides[2] = 1
+
+    with parallel(num_threads=nr_threads):
+        buf = <float *> malloc(3 * n * sizeof(float))
+        if buf == NULL:
+            with gil:
+                raise MemoryError()
+        for line in prange(shape[b] * shape[d], schedule='static'):
+            offset = (line // shape[d]) * strides[b] \
+                + (line % shape[d]) * strides[d]
+            if mode == DERIVATIVE:
+                derivative_line(x + offset, strides[axis], y + offset,
+                                strides[axis], n, buf, c)
+            else:
+                smoothing_line(x + offset, strides[axis], y + offset,
+                               strides[axis], n, buf, c,
+                               mode == SMOOTHING_ADD_SQUARE)
+        free(buf)
+    return 0
+
+
+cdef void deriche_coefficients(double alpha, double *c) noexcept nogil:
+    """Fill c with a_0, a_1, a_2, a_3, b_1, b_2 and alpha."""
+    cdef double s = (1 - exp(-alpha))**2 \
+        / (1 + 2*alpha*exp(-alpha) - exp(-2*alpha))
+    c[0] = s
+    c[1] = s * (alpha - 1) * exp(-alpha)
+    c[4] = -2 * exp(-alpha)
+    c[5] = exp(-2 * alpha)
+    c[2] = c[1] - s * c[4]
+    c[3] = -s * c[5]
+    c[6] = alpha
+
+
+def deriche_3D(const float[:, :, ::1] inputData, float alpha=1, int axis=0,
+               out=None, int nr_threads=0):
+    """Reference: Monga et al. 1991.
+
+    Derivative along the given axis, smoothing along the other two. Lines
+    are filtered in parallel with nr_threads threads (0 uses all cores),
+    each thread only keeps float32 buffers of one line. The result is
+    written into out (float32, C-contiguous) if given.
+    """
+    cdef double c[7]
+    cdef Py_ssize_t shape[3]
+    cdef int other
+
+    if axis < 0 or axis > 2:
+        raise ValueError('axis has to be 0, 1 or 2.')
+    dims = (inputData.shape[0], inputData.shape[1], inputData.shape[2])
+    if out is None:
+        out = np.empty(dims, dtype=np.float32)
+    cdef float[:, :, ::1] out_view = out
+    if (out_view.shape[0], out_view.shape[1], out_view.shape[2]) != dims:
+        raise ValueError('out has to have the shape of the input.')
+    if 0 in dims:
+        return out
+    if nr_threads < 1:
+        nr_threads = os.cpu_count() or 1
+
+    shape[0], shape[1], shape[2] = dims
+    deriche_coefficients(alpha, c)
+    # derivative into out, then in place smoothing along the other axes
+    with nogil:
+        filter_pass(&inputData[0, 0, 0], &out_view[0, 0, 0], shape, axis,
+                    DERIVATIVE, c, nr_threads)
+        for other in range(3):
+            if other != axis:
+                filter_pass(&out_view[0, 0, 0], &out_view[0, 0, 0], shape,
+                            other, SMOOTHING, c, nr_threads)
+    return out
+
+
+def deriche_3D_magnitude(const float[:, :, ::1] inputData, float alpha=1,
+                         out=None, int nr_threads=0):
+    """Deriche gradient magnitude, see deriche_3D.
+
+    The squared directional derivatives are accumulated directly into out
+    by the last smoothing pass, so one scratch volume is used in total.
+    """
+    cdef double c[7]
+    cdef Py_ssize_t shape[3]
+    cdef int axis, first, second
+
+    dims = (inputData.shape[0], inputData.shape[1], inputData.shape[2])
+    if out is None:
+        out = np.zeros(dims, dtype=np.float32)
+    else:
+        out[...] = 0
+    cdef float[:, :, ::1] out_view = out
+    if (out_view.shape[0], out_view.shape[1], out_view.shape[2]) != dims:
+        raise ValueError('out has to have the shape of the input.')
+    if 0 in dims:
+        return out
+    if nr_threads < 1:
+        nr_threads = os.cpu_count() or 1
+    cdef float[:, :, ::1] scratch = np.empty(dims, dtype=np.float32)
+
+    shape[0], shape[1], shape[2] = dims
+    deriche_coefficients(alpha, c)
+    with nogil:
+        for axis in range(3):
+            first = 1 if axis == 0 else 0
+            second = 1 if axis == 2 else 2
+            filter_pass(&inputData[0, 0, 0], &scratch[0, 0, 0], shape, axis,
+                        DERIVATIVE, c, nr_threads)
+            filter_pass(&scratch[0, 0, 0], &scratch[0, 0, 0], shape, first,
+                        SMOOTHING, c, nr_threads)
+            filter_pass(&scratch[0, 0, 0], &out_view[0, 0, 0], shape,
+                        second, SMOOTHING_ADD_SQUARE, c, nr_threads)
+    np.sqrt(out, out=out)
+    return out
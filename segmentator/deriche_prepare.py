@@ -3,40 +3,41 @@
 You can use --graMag flag to pass resulting nifti files from this script.
 """
 
-from segmentator.deriche_3D import deriche_3D
+from segmentator.deriche_3D import deriche_3D, deriche_3D_magnitude
 import numpy as np
 
 
 def Deriche_Gradient_Magnitude(image, alpha, normalize=False,
-                               return_gradients=False):
-    """Compute Deriche gradient magnitude of a volumetric image."""
-    # calculate gradients
+                               return_gradients=False, ima_range=None,
+                               nr_workers=0, out=None):
+    """Compute Deriche gradient magnitude of a volumetric image.
+
+    Use ima_range to pass already known (min, max) of the image, which is
+    used in normalization. Lines are filtered in parallel by the kernel with
+    nr_workers threads (0 uses all cores). Use out to pass a preallocated
+    float32 output.
+    """
     image = np.ascontiguousarray(image, dtype=np.float32)
-    gra_x = deriche_3D(image, alpha=alpha)
-    image = np.transpose(image, (2, 0, 1))
-    image = np.ascontiguousarray(image, dtype=np.float32)
-    gra_y = deriche_3D(image, alpha=alpha)
-    gra_y = np.transpose(gra_y, (1, 2, 0))
-    image = np.transpose(image, (2, 0, 1))
-    image = np.ascontiguousarray(image, dtype=np.float32)
-    gra_z = deriche_3D(image, alpha=alpha)
-    gra_z = np.transpose(gra_z, (2, 0, 1))
-
-    # Put the image gradients in 4D format
-    gradients = np.array([gra_x, gra_y, gra_z])
-    gradients = np.transpose(gradients, (1, 2, 3, 0))
 
     if return_gradients:
-        return gradients
+        # Put the image gradients in 4D format, gradient along axis d in
+        # [..., d]
+        if out is None:
+            out = np.empty((3,) + image.shape, dtype=np.float32)
+        for d in range(3):
+            deriche_3D(image, alpha=alpha, axis=d, out=out[d],
+                       nr_threads=nr_workers)
+        return np.moveaxis(out, 0, -1)
 
     else:  # Deriche gradient magnitude
-        gra_mag = np.sqrt(np.power(gradients[:, :, :, 0], 2.0) +
-                          np.power(gradients[:, :, :, 1], 2.0) +
-                          np.power(gradients[:, :, :, 2], 2.0))
+        gra_mag = deriche_3D_magnitude(image, alpha=alpha, out=out,
+                                       nr_threads=nr_workers)
         if normalize:
-            min_ima, max_ima = np.percentile(image, [0, 100])
-            min_der, max_der = np.percentile(gra_mag, [0, 100])
+            if ima_range is None:
+                ima_range = np.nanmin(image), np.nanmax(image)
+            min_ima, max_ima = ima_range
+            min_der, max_der = np.nanmin(gra_mag), np.nanmax(gra_mag)
             range_ima, range_der = max_ima - min_ima, max_der - min_der
 
-            gra_mag = gra_mag * (range_ima / range_der)
+            gra_mag *= range_ima / range_der
         return gra_mag
@@ -14,6 +14,7 @@ from segmentator.filters_utils import (
     compute_diffusion_weights, construct_diffusion_tensors,
     smooth_matrix_image)
 from scipy.ndimage.interpolation import zoom
+from segmentator.utils import load_data
 
 
 def QC_export(image, basename, identifier, nii):
@@ -46,10 +47,11 @@ basename = file_name.split(os.extsep, 1)[0]
 nii = load(file_name)
 vres = nii.header['pixdim'][1:4]  # voxel resolution x y z
 norm_vres = [r/min(vres) for r in vres]  # normalized voxel resolutions
-ima = (nii.get_data()).astype('float32')
+ima, _ = load_data(nii)
 
 if cfg.downsampling > 1:  # TODO: work in progress
     print('  Applying initial downsampling...')
+    full_ima = ima  # kept for final upsampling instead of loading again
     ima = zoom(ima, 1./cfg.downsampling)
     orig = np.copy(ima)
 else:
@@ -58,7 +60,7 @@ else:
 if cfg.no_nonpositive_mask:  # TODO: work in progress
     idx_msk_flat = np.ones(ima.size, dtype=bool)
 else:  # mask out non positive voxels
-    idx_msk_flat = ima.flatten() > 0
+    idx_msk_flat = ima.ravel() > 0
 
 dims = ima.shape
 
@@ -130,7 +132,8 @@ if cfg.downsampling > 1:  # TODO: work in progress
     print('  Final upsampling...')
     residual = ima - orig
     residual = zoom(residual, cfg.downsampling)
-    ima = (nii.get_data()).astype('float32') + residual
+    full_ima += residual
+    ima, full_ima = full_ima, None
 else:
     pass
 
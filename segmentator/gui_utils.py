@@ -3,14 +3,202 @@
 
 from __future__ import division, print_function
 import os
+import copy
+import threading
+import traceback
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.path import Path
 import segmentator.config as cfg
-from segmentator.utils import map_2D_hist_to_ima
+from segmentator.utils import map_2D_hist_to_ima, remap_2D_hist_bins
+from segmentator.utils import count_2D_hist_vox
+from segmentator.utils import invert_ima_to_2D_hist_map
+from segmentator.utils import relabel_2D_hist_mask
+from segmentator.selection import save_selection
 from nibabel import save, Nifti1Image
 from scipy.ndimage.morphology import binary_erosion
 
 
+def plot_2D_hist(ax, counts, bin_edges, cmap='Greys'):
+    """Draw 2D histogram counts (see utils.prep_2D_hist) as an image.
+
+    Parameters
+    ----------
+    ax : matplotlib.axes.Axes
+        Axes to draw on.
+    counts : np.ndarray
+        2D histogram counts, indexed as [intensity bin, gradient bin].
+    bin_edges : np.ndarray
+        Bin edges used for both axes.
+    cmap : string or matplotlib colormap
+        Colormap of the counts.
+
+    Returns
+    -------
+    volHistH : matplotlib.image.AxesImage
+        Image handle, e.g. to set the color normalization.
+
+    """
+    extent = [bin_edges[0], bin_edges[-1], bin_edges[0], bin_edges[-1]]
+    volHistH = ax.imshow(counts.T, cmap=cmap, origin='lower', aspect='auto',
+                         interpolation='nearest', extent=extent)
+    return volHistH
+
+
+class blit_manager:
+    """Redraw changed artists over a cached background of the figure.
+
+    The managed artists are animated, so full draws on screen leave them out
+    of the background. They are drawn on top after every full draw and on
+    their own in update. Saved figures include them as usual.
+    """
+
+    def __init__(self, canvas, artists=()):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        canvas : matplotlib.backend_bases.FigureCanvasBase
+            Canvas of the figure.
+        artists : list of matplotlib.artist.Artist
+            Artists that change during interaction, drawn in this order.
+
+        """
+        self.canvas = canvas
+        self.background, self.backgroundKey = None, None
+        self.artists = []
+        for artist in artists:
+            self.add_artist(artist)
+        self.cid = canvas.mpl_connect('draw_event', self.on_draw)
+
+    def add_artist(self, artist):
+        """Manage an artist, it has to be in the figure of the canvas."""
+        artist.set_animated(True)
+        self.artists.append(artist)
+
+    def remove_artist(self, artist):
+        """Stop managing an artist, e.g. after removing it from the axes."""
+        if artist in self.artists:
+            self.artists.remove(artist)
+
+    def figureKey(self):
+        """Size and resolution the background is valid for."""
+        figure = self.canvas.figure
+        return (tuple(figure.bbox.bounds), figure.dpi)
+
+    def on_draw(self, event):
+        """Cache the background, then draw the artists on top."""
+        if event.canvas.is_saving():  # saved figures include the artists
+            return
+        if getattr(self.canvas, 'supports_blit', False):
+            self.background = self.canvas.copy_from_bbox(
+                self.canvas.figure.bbox)
+            self.backgroundKey = self.figureKey()
+        for artist in self.artists:
+            if artist.figure is not None:
+                artist.draw(event.renderer)
+
+    def update(self):
+        """Redraw the artists, or the whole figure if needed."""
+        if self.background is None or self.backgroundKey != self.figureKey():
+            self.canvas.draw()  # also caches the background
+            return
+        self.canvas.restore_region(self.background)
+        figure = self.canvas.figure
+        for artist in self.artists:
+            if artist.figure is not None:
+                figure.draw_artist(artist)
+        self.canvas.blit(figure.bbox)
+        self.canvas.flush_events()
+
+
+class motion_scheduler:
+    """Compute only the latest of many requested updates in a worker thread.
+
+    Requests that arrive while the worker is busy replace each other, so
+    intermediate states are dropped. Results are applied in the GUI thread by
+    a canvas timer, which only runs while there is something to apply.
+    """
+
+    def __init__(self, canvas, compute, apply, interval=10):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        canvas : matplotlib.backend_bases.FigureCanvasBase
+            Canvas that provides the timer.
+        compute : function
+            Called with the requested state in the worker thread. Returns
+            True if there is something to apply.
+        apply : function
+            Called without arguments in the GUI thread.
+        interval : int
+            Timer interval in milliseconds.
+
+        """
+        self.compute, self.apply = compute, apply
+        self.condition = threading.Condition()
+        self.pending, self.busy, self.ready = None, False, False
+        self.thread = None
+        self.timer = canvas.new_timer(interval=interval)
+        self.timer.add_callback(self.on_timer)
+        self.timerActive = False
+
+    def submit(self, state):
+        """Request an update, replaces a request that has not started."""
+        with self.condition:
+            self.pending = state
+            if self.thread is None:  # started on first use
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+        if not self.timerActive:
+            self.timerActive = True
+            self.timer.start()
+
+    def run(self):
+        """Worker loop."""
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                state, self.pending = self.pending, None
+                self.busy = True
+            changed = False
+            try:
+                changed = self.compute(state)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.ready = self.ready or changed
+                    self.condition.notify_all()
+
+    def on_timer(self):
+        """Apply the latest result if there is a new one.
+
+        The timer is stopped when nothing is left to compute or apply, and
+        started again by submit.
+        """
+        with self.condition:
+            ready, self.ready = self.ready, False
+            idle = self.pending is None and not self.busy
+        if idle and not ready and self.timerActive:
+            self.timerActive = False
+            self.timer.stop()
+        if ready:
+            self.apply()
+
+    def wait(self):
+        """Wait until all requests are computed and apply the result."""
+        with self.condition:
+            while self.pending is not None or self.busy:
+                self.condition.wait()
+        self.on_timer()
+
+
 class responsiveObj:
     """Stuff to interact in the user interface."""
 
@@ -27,10 +215,28 @@ class responsiveObj:
         self.TranspVal = 0.5
         self.nrExports = 0
         self.borderSwitch = 0
-        self.imaSlc = self.orig[:, :, self.sliceNr]  # selected slice
+        # volumes keep their original orientation, views are cycled through
+        # the axes order and slices are rotated for display only
         self.cycleCount = 0
+        self.imaSlc = self.viewSlice(self.orig)  # selected slice
+        # unrotated slice masks, rotated for display in checkRotation
+        self.imaSlcLabels = self.imaSlcBorder = self.imaSlcMsk
         self.cycRotHistory = [[0, 0], [0, 0], [0, 0]]
         self.highlights = [[], []]  # to hold image to histogram circles
+        # used for incremental histogram to image mapping
+        self.lastVolHistLut, self.slcKey = None, None
+        self.slcBinPixels, self.slcBinOffsets = None, None
+        # labels of all voxels, kept in the original orientation
+        self.volLabels, self.staleBins = None, None
+        # remapping runs in a worker thread while the sector is dragged
+        self.remapLock = threading.RLock()
+        self.motionScheduler = motion_scheduler(
+            self.figure.canvas, self.remapMotion, self.applyMotion)
+        # only masks and slices are redrawn during interaction
+        artists = [self.volHistMaskH, self.imaSlcH, self.imaSlcMskH]
+        if hasattr(self, 'pltMapH'):
+            artists.insert(0, self.pltMapH)
+        self.blitter = blit_manager(self.figure.canvas, artists)
 
     def remapMsks(self, remap_slice=True):
         """Update volume histogram to image mapping.
@@ -40,47 +246,218 @@ class responsiveObj:
         remap_slice : bool
             Do histogram to image mapping. Used to map displayed slice mask.
 
+        Returns
+        -------
+        changed : bool
+            False if neither the volume histogram mask nor the displayed
+            slice changed since the last call. Nothing is remapped then.
+
+        Notes
+        -----
+        The labels of all voxels are kept in a label volume, so that showing
+        another slice only takes a view of it. Bins that entered or left the
+        selection are marked as stale and their voxels are relabeled when
+        another slice is shown or the labels are exported. While the slice
+        stays the same, only its pixels in these bins are updated, using a
+        bin to pixel index of the displayed slice. Artists are updated in
+        updatePanels.
+
+        The remap is split into remapJob, remapCompute and remapCommit, so
+        that the motion worker only holds remapLock to collect its inputs
+        and to store the results (see remapMotion).
+
         """
+        with self.remapLock:
+            job = self.remapJob(remap_slice)
+            self.remapCompute(job)
+            return self.remapCommit(job)
+
+    def remapJob(self, remap_slice=True):
+        """Collect the inputs of a remap, called with remapLock held.
+
+        Returns
+        -------
+        job : dict
+            Copies of the sector and lasso (main) or of the labels (ncut) and
+            the state of the last remap, so that remapCompute does not read
+            attributes that other threads change.
+
+        """
+        job = dict(remapSlice=remap_slice, lastLut=self.lastVolHistLut,
+                   slcKey=(self.cycleCount, self.sliceNr, self.borderSwitch),
+                   lastSlcKey=self.slcKey, imaSlcLabels=self.imaSlcLabels,
+                   slcBinPixels=self.slcBinPixels,
+                   slcBinOffsets=self.slcBinOffsets,
+                   invHistSlice=self.viewSlice(self.invHistVolume))
         if self.segmType == 'main':
-            self.volHistMask = self.sectorObj.binaryMask()
-            self.volHistMask = self.lassoArr(self.volHistMask, self.idxLasso)
-            self.volHistMaskH.set_data(self.volHistMask)
-        elif self.segmType == 'ncut':
+            job['sector'] = copy.copy(self.sectorObj)
+            job['lasso'] = self.lassoObj.mask.copy()
+        else:
+            job['volHistMask'] = np.array(self.volHistMask)
+        return job
+
+    def remapCompute(self, job):
+        """Compute the masks of a remap job, does not need remapLock.
+
+        Only the job is changed. The pixels of the displayed slice are
+        updated in a copy.
+        """
+        if 'sector' in job:
+            job['volHistMask'] = np.logical_or(job['sector'].binaryMask(),
+                                               job['lasso'])
+        # label lookup table, voxels in bin 0 are left out if discard zeros
+        lut = np.array(job['volHistMask']).ravel()
+        if lut.dtype == bool:
+            lut = lut.astype(np.uint8)
+        if cfg.discard_zeros:
+            lut[0] = 0
+        lastLut = job['lastLut']
+        if lastLut is None or lastLut.dtype != lut.dtype:
+            binChanged = np.ones(lut.shape, dtype=bool)
+        else:
+            binChanged = lut != lastLut
+        slcKey, lastSlcKey = job['slcKey'], job['lastSlcKey']
+        job.update(lut=lut, binChanged=binChanged, newSlice=(
+            lastSlcKey is None or slcKey[0:2] != lastSlcKey[0:2]))
+        if not job['remapSlice'] or job['newSlice']:
+            return  # the label volume is updated in remapCommit
+        labels = job['imaSlcLabels']
+        if binChanged.any():
+            # same slice, update pixels of the changed bins only
+            if job['slcBinPixels'] is None:
+                job['slcBinPixels'], job['slcBinOffsets'] = \
+                    invert_ima_to_2D_hist_map(job['invHistSlice'],
+                                              self.nrBins)
+            labels = labels.copy()
+            remap_2D_hist_bins(labels, job['slcBinPixels'],
+                               job['slcBinOffsets'], lut, binChanged)
+            job['labels'] = labels
+        if slcKey[2] == 1 and (binChanged.any() or slcKey != lastSlcKey):
+            job['border'] = self.calcImaMaskBrd(labels)
+
+    def remapCommit(self, job):
+        """Store the results of a remap job, called with remapLock held.
+
+        Returns
+        -------
+        changed : bool
+            See remapMsks.
+
+        """
+        lut, binChanged = job['lut'], job['binChanged']
+        if self.volLabels is None or self.volLabels.dtype != lut.dtype:
+            self.volLabels = np.zeros(self.invHistVolume.shape, lut.dtype)
+            self.staleBins, job['newSlice'] = None, True
+        if not binChanged.any() and (not job['remapSlice']
+                                     or job['slcKey'] == job['lastSlcKey']):
+            return False
+        if 'sector' in job:
+            self.volHistMask = job['volHistMask']
+            if job['sector'].maskKey == self.sectorObj.currentKey():
+                # keep the rasterised mask of the copy
+                self.sectorObj.maskKey = job['sector'].maskKey
+                self.sectorObj.mask = job['sector'].mask
+        self.lastVolHistLut = lut
+        if self.staleBins is None:
+            self.staleBins = binChanged
+        else:
+            self.staleBins |= binChanged
+
+        if self.segmType == 'ncut':
             self.labelContours()
-            self.volHistMaskH.set_data(self.volHistMask)
-            self.volHistMaskH.set_extent((0, self.nrBins, self.nrBins, 0))
         # histogram to image mapping
-        if remap_slice:
-            temp_slice = self.invHistVolume[:, :, self.sliceNr]
-            image_slice_shape = self.invHistVolume[:, :, self.sliceNr].shape
-            if cfg.discard_zeros:
-                zmask = temp_slice != 0
-                image_slice_mask = map_2D_hist_to_ima(temp_slice[zmask],
-                                                      self.volHistMask)
-                # reshape to image slice shape
-                self.imaSlcMsk = np.zeros(image_slice_shape)
-                self.imaSlcMsk[zmask] = image_slice_mask
-            else:
-                image_slice_mask = map_2D_hist_to_ima(temp_slice.flatten(),
-                                                      self.volHistMask)
-                # reshape to image slice shape
-                self.imaSlcMsk = image_slice_mask.reshape(image_slice_shape)
+        if job['remapSlice']:
+            if job['newSlice']:
+                # new slice, a view of the up to date label volume
+                self.updateLabelVolume()
+                self.imaSlcLabels = self.viewSlice(self.volLabels)
+                self.slcBinPixels, self.slcBinOffsets = None, None
+            elif 'labels' in job:
+                self.imaSlcLabels = job['labels']
+                self.slcBinPixels = job['slcBinPixels']
+                self.slcBinOffsets = job['slcBinOffsets']
+            self.imaSlcMsk = self.imaSlcLabels
+            self.slcKey = job['slcKey']
 
             # for optional border visualization
             if self.borderSwitch == 1:
-                self.imaSlcMsk = self.calcImaMaskBrd()
+                self.imaSlcBorder = job.get('border')
+                if job['newSlice'] or self.imaSlcBorder is None:
+                    self.imaSlcBorder = self.calcImaMaskBrd(self.imaSlcLabels)
+                self.imaSlcMsk = self.imaSlcBorder
+        else:
+            self.slcKey = None  # displayed slice is out of date
+        return True
+
+    def updateLabelVolume(self):
+        """Relabel the voxels of stale bins in the label volume."""
+        with self.remapLock:
+            if self.staleBins is None or not self.staleBins.any():
+                return
+            lut = self.lastVolHistLut
+            nrStale = count_2D_hist_vox(self.binOffsets, self.staleBins)
+            if nrStale > self.volLabels.size // 4:
+                # a single gather is faster than scattering most voxels
+                self.volLabels[...] = map_2D_hist_to_ima(
+                    self.invHistVolume, lut)
+            else:
+                remap_2D_hist_bins(self.volLabels, self.binVoxels,
+                                   self.binOffsets, lut, self.staleBins)
+            self.staleBins[:] = False
+
+    def cyclePerm(self):
+        """Axes order of the displayed view of an original volume."""
+        return ((3 - self.cycleCount) % 3, (4 - self.cycleCount) % 3,
+                (5 - self.cycleCount) % 3)
+
+    def viewSlice(self, volume):
+        """Select the displayed slice of a volume.
+
+        Parameters
+        ----------
+        volume : np.ndarray, 3D
+            Volume in the original orientation, e.g. orig or invHistVolume.
+
+        Returns
+        -------
+        ima : np.ndarray, 2D
+            Slice in the current view, a strided view of the volume. Display
+            rotation is not applied (see rotateSlice).
+
+        """
+        return np.transpose(volume, self.cyclePerm())[:, :, self.sliceNr]
+
+    def rotateSlice(self, ima):
+        """Rotate a slice as it is displayed in the current view."""
+        cyc_rot = self.cycRotHistory[self.cycleCount][1]
+        if cyc_rot == 1:  # 90
+            return np.rot90(ima, axes=(0, 1))
+        elif cyc_rot == 2:  # 180
+            return ima[::-1, ::-1]
+        elif cyc_rot == 3:  # 270
+            return np.rot90(ima, axes=(1, 0))
+        return ima
 
     def updatePanels(self, update_slice=True, update_rotation=False,
                      update_extent=False):
         """Update histogram and image panels."""
-        if update_rotation:
-            self.checkRotation()
-        if update_extent:
-            self.updateImaExtent()
-        if update_slice:
-            self.imaSlcH.set_data(self.imaSlc)
-        self.imaSlcMskH.set_data(self.imaSlcMsk)
-        self.figure.canvas.draw()
+        with self.remapLock:
+            if update_rotation:
+                self.checkRotation()
+            # a new extent changes the axes, so everything is redrawn then
+            redraw = update_extent and self.updateImaExtent()
+            self.volHistMaskH.set_data(self.volHistMask)
+            if self.segmType == 'ncut':
+                self.volHistMaskH.set_extent((0, self.nrBins, self.nrBins, 0))
+                self.pltMapH.set_data(self.pltMap)
+                self.pltMapH.set_extent((0, self.nrBins, self.nrBins, 0))
+            if update_slice:
+                self.imaSlcH.set_data(self.imaSlc)
+            self.imaSlcMskH.set_data(self.imaSlcMsk)
+        if redraw:
+            self.figure.canvas.draw()
+        else:
+            self.blitter.update()
 
     def connect(self):
         """Make the object responsive."""
@@ -115,23 +492,19 @@ class responsiveObj:
 
         if self.segmType == 'main':
             if event.key == 'up':
-                self.sectorObj.scale_r(1.05)
-                self.remapMsks()
+                self.moveSector(self.sectorObj.scale_r, 1.05)
                 self.updatePanels(update_slice=False, update_rotation=True,
                                   update_extent=False)
             elif event.key == 'down':
-                self.sectorObj.scale_r(0.95)
-                self.remapMsks()
+                self.moveSector(self.sectorObj.scale_r, 0.95)
                 self.updatePanels(update_slice=False, update_rotation=True,
                                   update_extent=False)
             elif event.key == 'right':
-                self.sectorObj.rotate(-10.0)
-                self.remapMsks()
+                self.moveSector(self.sectorObj.rotate, -10.0)
                 self.updatePanels(update_slice=False, update_rotation=True,
                                   update_extent=False)
             elif event.key == 'left':
-                self.sectorObj.rotate(10.0)
-                self.remapMsks()
+                self.moveSector(self.sectorObj.rotate, 10.0)
                 self.updatePanels(update_slice=True, update_rotation=True,
                                   update_extent=False)
             else:
@@ -147,15 +520,8 @@ class responsiveObj:
         self.press = event.xdata, event.ydata
         pixel_x = int(np.floor(event.xdata))
         pixel_y = int(np.floor(event.ydata))
-        aoi = self.invHistVolume[:, :, self.sliceNr]  # array of interest
-        # Check rotation
-        cyc_rot = self.cycRotHistory[self.cycleCount][1]
-        if cyc_rot == 1:  # 90
-            aoi = np.rot90(aoi, axes=(0, 1))
-        elif cyc_rot == 2:  # 180
-            aoi = aoi[::-1, ::-1]
-        elif cyc_rot == 3:  # 270
-            aoi = np.rot90(aoi, axes=(1, 0))
+        # array of interest, rotated as displayed
+        aoi = self.rotateSlice(self.viewSlice(self.invHistVolume))
         # Switch x and y voxel to get linear index since not Cartesian!!!
         pixelLin = aoi[pixel_y, pixel_x]
         # ind2sub
@@ -170,7 +536,9 @@ class responsiveObj:
                                   edgecolor=None, color=circle_colors[1]))
         self.axes.add_artist(self.highlights[0][-1])  # small circle
         self.axes.add_artist(self.highlights[1][-1])  # large circle
-        self.figure.canvas.draw()
+        self.blitter.add_artist(self.highlights[0][-1])
+        self.blitter.add_artist(self.highlights[1][-1])
+        self.blitter.update()
 
     def on_press(self, event):
         """Determine what happens if mouse button is clicked."""
@@ -197,13 +565,11 @@ class responsiveObj:
                     return
                 # increase/decrease radius of the sector mask
                 if self.ctrlHeld is False:  # ctrl no
-                    self.sectorObj.scale_r(1.05)
-                    self.remapMsks()
+                    self.moveSector(self.sectorObj.scale_r, 1.05)
                     self.updatePanels(update_slice=False, update_rotation=True,
                                       update_extent=False)
                 elif self.ctrlHeld is True:  # ctrl yes
-                    self.sectorObj.rotate(10.0)
-                    self.remapMsks()
+                    self.moveSector(self.sectorObj.rotate, 10.0)
                     self.updatePanels(update_slice=False, update_rotation=True,
                                       update_extent=False)
                 else:
@@ -213,13 +579,11 @@ class responsiveObj:
                     return
                 # rotate the sector mask
                 if self.ctrlHeld is False:  # ctrl no
-                    self.sectorObj.scale_r(0.95)
-                    self.remapMsks()
+                    self.moveSector(self.sectorObj.scale_r, 0.95)
                     self.updatePanels(update_slice=False, update_rotation=True,
                                       update_extent=False)
                 elif self.ctrlHeld is True:  # ctrl yes
-                    self.sectorObj.rotate(-10.0)
-                    self.remapMsks()
+                    self.moveSector(self.sectorObj.rotate, -10.0)
                     self.updatePanels(update_slice=False, update_rotation=True,
                                       update_extent=False)
                 else:
@@ -283,24 +647,60 @@ class responsiveObj:
             # switch x0 & y0 cause volHistMask not Cart
             dy = event.xdata - xpress
             dx = event.ydata - ypress
-            # update x and y position of sector,
-            # based on past motion of cursor
-            self.sectorObj.set_x(x0 + dx)
-            self.sectorObj.set_y(y0 + dy)
-            # update masks
-            self.remapMsks()
-            self.updatePanels(update_slice=False, update_rotation=True,
-                              update_extent=False)
+            # request the new sector position, intermediate positions are
+            # skipped while masks are being remapped
+            self.motionScheduler.submit((x0 + dx, y0 + dy))
         else:
             return
 
+    def remapMotion(self, centre):
+        """Move the sector and remap masks (runs in the motion worker).
+
+        remapLock is only held to move the sector, collect the inputs and
+        store the results, so the GUI thread is not blocked while the masks
+        are computed. If the GUI thread remapped in the meantime, the
+        results are outdated and the remap is repeated with the lock held.
+        """
+        with self.remapLock:
+            self.sectorObj.set_x(centre[0])
+            self.sectorObj.set_y(centre[1])
+            job = self.remapJob()
+        self.remapCompute(job)
+        with self.remapLock:
+            current = (self.lastVolHistLut is job['lastLut']
+                       and self.slcKey == job['lastSlcKey']
+                       and self.imaSlcLabels is job['imaSlcLabels']
+                       and self.sectorObj.currentKey()
+                       == job['sector'].currentKey()
+                       and job['slcKey'] == (self.cycleCount, self.sliceNr,
+                                             self.borderSwitch))
+            if not current:
+                return self.remapMsks()
+            return self.remapCommit(job)
+
+    def moveSector(self, move, *args):
+        """Change the sector with move(*args) and remap masks.
+
+        The sector is changed with remapLock held, so that the motion worker
+        never reads it half way through a change.
+        """
+        with self.remapLock:
+            move(*args)
+            return self.remapMsks()
+
+    def applyMotion(self):
+        """Show the masks of the last sector position."""
+        self.updatePanels(update_slice=False, update_rotation=True,
+                          update_extent=False)
+
     def on_release(self, event):
         """Determine what happens if mouse button is released."""
         self.press = None
+        self.motionScheduler.wait()  # show the final sector position
         # Remove highlight circle
         if self.highlights[1]:
             self.highlights[1][-1].set_visible(False)
-        self.figure.canvas.draw()
+        self.blitter.update()
 
     def disconnect(self):
         """Make the object unresponsive."""
@@ -311,12 +711,13 @@ class responsiveObj:
     def updateColorBar(self, val):
         """Update slider for scaling log colorbar in 2D hist."""
         histVMax = np.power(10, self.sHistC.val)
-        plt.clim(vmax=histVMax)
+        self.volHistH.set_clim(vmax=histVMax)
 
     def updateSliceNr(self):
         """Update slice number and the selected slice."""
-        self.sliceNr = int(self.sSliceNr.val*self.orig.shape[2])
-        self.imaSlc = self.orig[:, :, self.sliceNr]
+        nrSlices = self.orig.shape[self.cyclePerm()[2]]
+        self.sliceNr = int(self.sSliceNr.val*nrSlices)
+        self.imaSlc = self.viewSlice(self.orig)
 
     def updateImaBrowser(self, val):
         """Update image browse."""
@@ -327,76 +728,75 @@ class responsiveObj:
                           update_extent=True)
 
     def updateImaExtent(self):
-        """Update both image and mask extent in image browser."""
-        self.imaSlcH.set_extent((0, self.imaSlc.shape[1],
-                                 self.imaSlc.shape[0], 0))
-        self.imaSlcMskH.set_extent((0, self.imaSlc.shape[1],
-                                    self.imaSlc.shape[0], 0))
+        """Update both image and mask extent in image browser.
+
+        Returns
+        -------
+        changed : bool
+            True if the extent changed.
+
+        """
+        extent = (0, self.imaSlc.shape[1], self.imaSlc.shape[0], 0)
+        if tuple(self.imaSlcH.get_extent()) == extent:
+            return False
+        self.imaSlcH.set_extent(extent)
+        self.imaSlcMskH.set_extent(extent)
+        return True
 
     def cycleView(self, event):
         """Cycle through views."""
+        # only the axes order changes, slices are taken as views (viewSlice)
         self.cycleCount = (self.cycleCount + 1) % 3
-        # transpose data
-        self.orig = np.transpose(self.orig, (2, 0, 1))
-        # transpose ima2volHistMap
-        self.invHistVolume = np.transpose(self.invHistVolume, (2, 0, 1))
         # updates
         self.updateSliceNr()
         self.remapMsks()
         self.updatePanels(update_slice=True, update_rotation=True,
                           update_extent=True)
 
-    def rotateIma90(self, axes=(0, 1)):
-        """Rotate image slice 90 degrees."""
-        self.imaSlc = np.rot90(self.imaSlc, axes=axes)
-        self.imaSlcMsk = np.rot90(self.imaSlcMsk, axes=axes)
-
     def changeRotation(self, event):
         """Change rotation of image after clicking the button."""
         self.cycRotHistory[self.cycleCount][1] += 1
         self.cycRotHistory[self.cycleCount][1] %= 4
-        self.rotateIma90()
-        self.updatePanels(update_slice=True, update_rotation=False,
+        self.updatePanels(update_slice=True, update_rotation=True,
                           update_extent=True)
 
     def checkRotation(self):
-        """Check rotation update if changed."""
-        cyc_rot = self.cycRotHistory[self.cycleCount][1]
-        if cyc_rot == 1:  # 90
-            self.rotateIma90(axes=(0, 1))
-        elif cyc_rot == 2:  # 180
-            self.imaSlc = self.imaSlc[::-1, ::-1]
-            self.imaSlcMsk = self.imaSlcMsk[::-1, ::-1]
-        elif cyc_rot == 3:  # 270
-            self.rotateIma90(axes=(1, 0))
+        """Rotate the displayed slice and mask as in the current view.
+
+        Both are taken from the unrotated slice and masks, so calling this
+        again, e.g. after remapMsks found nothing to update, does not rotate
+        them twice.
+        """
+        self.imaSlc = self.rotateSlice(self.viewSlice(self.orig))
+        if self.borderSwitch == 1:
+            self.imaSlcMsk = self.rotateSlice(self.imaSlcBorder)
+        else:
+            self.imaSlcMsk = self.rotateSlice(self.imaSlcLabels)
 
     def exportNifti(self, event):
         """Export labels in the image browser as a nifti file."""
         print("  Exporting nifti file...")
-        # put the permuted indices back to their original format
-        cycBackPerm = (self.cycleCount, (self.cycleCount+1) % 3,
-                       (self.cycleCount+2) % 3)
         # assing unique integers (for ncut labels)
-        out_volHistMask = np.copy(self.volHistMask)
-        labels = np.unique(self.volHistMask)
-        intLabels = [i for i in range(labels.size)]
-        for label, newLabel in zip(labels, intLabels):
-            out_volHistMask[out_volHistMask == label] = intLabels[newLabel]
-        # get 3D brain mask
-        volume_image = np.transpose(self.invHistVolume, cycBackPerm)
-        if cfg.discard_zeros:
-            zmask = volume_image != 0
-            temp_labeled_image = map_2D_hist_to_ima(volume_image[zmask],
-                                                    out_volHistMask)
-            out_nii = np.zeros(volume_image.shape)
-            out_nii[zmask] = temp_labeled_image  # put back flat labels
+        out_volHistMask = relabel_2D_hist_mask(self.volHistMask,
+                                               cfg.discard_zeros)
+        out_dtype = out_volHistMask.dtype
+        # the label volume holds the selected labels of every voxel
+        self.updateLabelVolume()
+        values = np.unique(np.asarray(self.volHistMask).astype(
+            self.volLabels.dtype))
+        valueLut = np.searchsorted(
+            values, np.arange(int(values[-1]) + 1)).astype(out_dtype)
+        if (self.volLabels.dtype == out_dtype
+                and np.array_equal(valueLut, np.arange(valueLut.size))):
+            out_nii = self.volLabels  # labels are already ascending
         else:
-            out_nii = map_2D_hist_to_ima(volume_image.flatten(),
-                                         out_volHistMask)
-            out_nii = out_nii.reshape(volume_image.shape)
+            out_nii = valueLut[self.volLabels]
+        print("    Nr. of labeled voxels: {}".format(
+            count_2D_hist_vox(self.binOffsets, out_volHistMask)))
         # save mask image as nii
-        new_image = Nifti1Image(out_nii, header=self.nii.get_header(),
-                                affine=self.nii.get_affine())
+        new_image = Nifti1Image(out_nii, header=self.nii.header,
+                                affine=self.nii.affine)
+        new_image.set_data_dtype(out_dtype)  # do not inherit input type
         # get new flex file name and check for overwriting
         labels_out = '{}_labels_{}.nii.gz'.format(
             self.basename, self.nrExports)
@@ -409,10 +809,10 @@ class responsiveObj:
 
     def clearOverlays(self):
         """Clear overlaid items such as circle highlights."""
-        if self.highlights[0]:
-            {h.remove() for h in self.highlights[0]}
-            {h.remove() for h in self.highlights[1]}
-        self.highlights[0] = []
+        for h in self.highlights[0] + self.highlights[1]:
+            h.remove()
+            self.blitter.remove_artist(h)
+        self.highlights = [[], []]
 
     def resetGlobal(self, event):
         """Reset stuff."""
@@ -424,17 +824,19 @@ class responsiveObj:
         self.TranspVal = 0.5
         if self.segmType == 'main':
             if self.lassoSwitchCount == 1:  # reset only lasso drawing
-                self.idxLasso = np.zeros(self.nrBins*self.nrBins, dtype=bool)
+                with self.remapLock:  # also read by the motion worker
+                    self.lassoObj.reset()
             else:
                 # reset theta sliders
                 self.sThetaMin.reset()
                 self.sThetaMax.reset()
                 # reset values for mask
-                self.sectorObj.set_x(cfg.init_centre[0])
-                self.sectorObj.set_y(cfg.init_centre[1])
-                self.sectorObj.set_r(cfg.init_radius)
-                self.sectorObj.tmin, self.sectorObj.tmax = np.deg2rad(
-                    cfg.init_theta)
+                with self.remapLock:  # also read by the motion worker
+                    self.sectorObj.set_x(cfg.init_centre[0])
+                    self.sectorObj.set_y(cfg.init_centre[1])
+                    self.sectorObj.set_r(cfg.init_radius)
+                    self.sectorObj.tmin, self.sectorObj.tmax = np.deg2rad(
+                        cfg.init_theta)
 
         elif self.segmType == 'ncut':
             self.sLabelNr.reset()
@@ -457,8 +859,7 @@ class responsiveObj:
         """Update theta (min) in volume histogram mask."""
         if self.segmType == 'main':
             theta_val = self.sThetaMin.val  # get theta value from slider
-            self.sectorObj.theta_min(theta_val)
-            self.remapMsks()
+            self.moveSector(self.sectorObj.theta_min, theta_val)
             self.updatePanels(update_slice=False, update_rotation=True,
                               update_extent=False)
         else:
@@ -468,27 +869,35 @@ class responsiveObj:
         """Update theta(max) in volume histogram mask."""
         if self.segmType == 'main':
             theta_val = self.sThetaMax.val  # get theta value from slider
-            self.sectorObj.theta_max(theta_val)
-            self.remapMsks()
+            self.moveSector(self.sectorObj.theta_max, theta_val)
             self.updatePanels(update_slice=False, update_rotation=True,
                               update_extent=False)
         else:
             return
 
     def exportNyp(self, event):
-        """Export histogram counts as a numpy array."""
+        """Export histogram counts or labels and the selection."""
         print("  Exporting numpy file...")
         outFileName = '{}_identifier_pcMax{}_pcMin{}_sc{}'.format(
             self.basename, cfg.perc_max, cfg.perc_min, int(cfg.scale))
         if self.segmType == 'ncut':
             outFileName = outFileName.replace('identifier', 'volHistLabels')
             out_data = self.volHistMask
+            sector, idxLasso = None, None
         elif self.segmType == 'main':
             outFileName = outFileName.replace('identifier', 'volHist')
             out_data = self.counts
+            sector, idxLasso = self.sectorObj, self.lassoObj.mask
         outFileName = outFileName.replace('.', 'pt')
         np.save(outFileName, out_data)
         print("    Saved as: {}{}".format(outFileName, '.npy'))
+        # selection with its parameters, can be applied in batch mode
+        selFileName = '{}_selection_pcMax{}_pcMin{}_sc{}'.format(
+            self.basename, cfg.perc_max, cfg.perc_min, int(cfg.scale))
+        selFileName = save_selection(
+            selFileName.replace('.', 'pt'), self.volHistMask, params=cfg,
+            sector=sector, idxLasso=idxLasso)
+        print("    Selection saved as: {}".format(selFileName))
 
     def updateLabels(self, val):
         """Update labels in volume histogram with slider."""
@@ -502,7 +911,7 @@ class responsiveObj:
         if (self.TranspVal + incr >= 0) & (self.TranspVal + incr <= 1):
             self.TranspVal += incr
         self.imaSlcMskH.set_alpha(self.TranspVal)
-        self.figure.canvas.draw()
+        self.blitter.update()
 
     def imaSlcMskTransSwitch(self):
         """Update transparency of image mask to toggle transparency."""
@@ -511,7 +920,7 @@ class responsiveObj:
             self.imaSlcMskH.set_alpha(0)
         else:  # set imaSlcMsk opaque
             self.imaSlcMskH.set_alpha(self.TranspVal)
-        self.figure.canvas.draw()
+        self.blitter.update()
 
     def volHistHighlightTransSwitch(self):
         """Update transparency of highlights to toggle transparency."""
@@ -521,7 +930,7 @@ class responsiveObj:
                 {h.set_visible(False) for h in self.highlights[0]}
         elif self.volHistHighlightSwitch == 0 and self.highlights[0]:
                 {h.set_visible(True) for h in self.highlights[0]}
-        self.figure.canvas.draw()
+        self.blitter.update()
 
     def updateLabelsRadio(self, val):
         """Update labels with radio buttons."""
@@ -533,19 +942,10 @@ class responsiveObj:
         grad = np.gradient(self.volHistMask)
         self.pltMap = np.greater(np.sqrt(np.power(grad[0], 2) +
                                          np.power(grad[1], 2)), 0)
-        self.pltMapH.set_data(self.pltMap)
-        self.pltMapH.set_extent((0, self.nrBins, self.nrBins, 0))
-
-    def lassoArr(self, array, indices):
-        """Update lasso volume histogram mask."""
-        lin = np.arange(array.size)
-        newArray = array.flatten()
-        newArray[lin[indices]] = True
-        return newArray.reshape(array.shape)
 
-    def calcImaMaskBrd(self):
+    def calcImaMaskBrd(self, imaSlcMsk):
         """Calculate borders of image mask slice."""
-        return self.imaSlcMsk - binary_erosion(self.imaSlcMsk)
+        return imaSlcMsk - binary_erosion(imaSlcMsk)
 
 
 class sector_mask:
@@ -561,36 +961,21 @@ class sector_mask:
     def __init__(self, shape, centre, radius, angle_range):
         """Initialize variables used acros functions here."""
         self.radius, self.shape = radius, shape
-        self.x, self.y = np.ogrid[:shape[0], :shape[1]]
         self.cx, self.cy = centre
         self.tmin, self.tmax = np.deg2rad(angle_range)
         # ensure stop angle > start angle
         if self.tmax < self.tmin:
             self.tmax += 2 * np.pi
-        # convert cartesian to polar coordinates
-        self.r2 = (self.x - self.cx) * (self.x - self.cx) + (
-            self.y-self.cy) * (self.y - self.cy)
-        self.theta = np.arctan2(self.x - self.cx, self.y - self.cy) - self.tmin
-        # wrap angles between 0 and 2*pi
-        self.theta %= 2 * np.pi
-
-    def set_polCrd(self):
-        """Convert cartesian to polar coordinates."""
-        self.r2 = (self.x-self.cx)*(self.x-self.cx) + (
-            self.y-self.cy)*(self.y-self.cy)
-        self.theta = np.arctan2(self.x-self.cx, self.y-self.cy) - self.tmin
-        # wrap angles between 0 and 2*pi
-        self.theta %= (2*np.pi)
+        # last rasterised mask and the parameters it was computed with
+        self.maskKey, self.mask = None, None
 
     def set_x(self, x):
         """Set x axis value."""
         self.cx = x
-        self.set_polCrd()  # update polar coordinates
 
     def set_y(self, y):
         """Set y axis value."""
         self.cy = y
-        self.set_polCrd()  # update polar coordinates
 
     def set_r(self, radius):
         """Set radius of the circle."""
@@ -605,7 +990,6 @@ class sector_mask:
         rad = np.deg2rad(degree)
         self.tmin += rad
         self.tmax += rad
-        self.set_polCrd()  # update polar coordinates
 
     def theta_min(self, degree):
         """Angle to determine one the cut out piece in circular mask."""
@@ -617,8 +1001,6 @@ class sector_mask:
         # ensure stop angle- 2*np.pi NOT > start angle
         if self.tmax - 2*np.pi >= self.tmin:
             self.tmax -= 2*np.pi
-        # update polar coordinates
-        self.set_polCrd()
 
     def theta_max(self, degree):
         """Angle to determine one the cut out piece in circular mask."""
@@ -630,28 +1012,51 @@ class sector_mask:
         # ensure stop angle- 2*np.pi NOT > start angle
         if self.tmax - 2*np.pi >= self.tmin:
             self.tmax -= 2*np.pi
-        # update polar coordinates
-        self.set_polCrd()
+
+    def inSector(self, x, y):
+        """Test if cells at x (row) and y (column) are inside the sector."""
+        # convert cartesian to polar coordinates
+        r2 = (x - self.cx) * (x - self.cx) + (y - self.cy) * (y - self.cy)
+        theta = np.arctan2(x - self.cx, y - self.cy) - self.tmin
+        # wrap angles between 0 and 2*pi
+        theta %= 2 * np.pi
+        return (r2 <= self.radius*self.radius) & (theta <= self.tmax-self.tmin)
+
+    def currentKey(self):
+        """Parameters that determine the mask."""
+        return (self.cx, self.cy, self.radius, self.tmin, self.tmax)
 
     def binaryMask(self):
-        """Return a boolean mask for a circular sector."""
-        # circular mask
-        self.circmask = self.r2 <= self.radius*self.radius
-        # angular mask
-        self.anglemask = self.theta <= (self.tmax-self.tmin)
-        # return binary mask
-        return self.circmask*self.anglemask
+        """Return a boolean mask for a circular sector.
+
+        Only the cells within the bounding box of the circle are tested. The
+        mask is kept until the sector changes and is read only.
+        """
+        maskKey = self.currentKey()
+        if maskKey == self.maskKey:
+            return self.mask
+        mask = np.zeros(self.shape, dtype=bool)
+        # bounding box of the circle, one cell margin for rounding
+        x0 = max(int(np.floor(self.cx - self.radius)), 0)
+        x1 = min(int(np.ceil(self.cx + self.radius)) + 1, self.shape[0])
+        y0 = max(int(np.floor(self.cy - self.radius)), 0)
+        y1 = min(int(np.ceil(self.cy + self.radius)) + 1, self.shape[1])
+        if x0 < x1 and y0 < y1:
+            x, y = np.ogrid[x0:x1, y0:y1]
+            mask[x0:x1, y0:y1] = self.inSector(x, y)
+        mask.flags.writeable = False
+        self.maskKey, self.mask = maskKey, mask
+        return mask
 
     def contains(self, event):
         """Check if a cursor pointer is inside the sector mask."""
-        xbin = np.floor(event.xdata)
-        ybin = np.floor(event.ydata)
-        Mask = self.binaryMask()
-        # the next line doesn't follow pep 8 (otherwise it fails)
-        if Mask[ybin][xbin] is True:  # switch x and ybin, volHistMask not Cart
-            return True
-        else:
+        if event.xdata is None or event.ydata is None:
             return False
+        # switch x and y, volHistMask not Cartesian
+        xbin, ybin = np.floor(event.ydata), np.floor(event.xdata)
+        if not (0 <= xbin < self.shape[0] and 0 <= ybin < self.shape[1]):
+            return False
+        return bool(self.inSector(xbin, ybin))
 
     def draw(self, ax, cmap='Reds', alpha=0.2, vmin=0.1, zorder=0,
              interpolation='nearest', origin='lower', extent=[0, 100, 0, 100]):
@@ -661,3 +1066,55 @@ class sector_mask:
                            interpolation=interpolation, origin=origin,
                            extent=extent, zorder=zorder)
         return (FigObj, BinMask)
+
+
+class lasso_mask:
+    """Persistent boolean mask of the bins selected with the lasso tool."""
+
+    def __init__(self, shape, radius=1.5):
+        """Initialize variables used acros functions here.
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the volume histogram.
+        radius : float
+            Bins this close to the lasso path are included.
+
+        """
+        self.shape, self.radius = shape, radius
+        self.mask = np.zeros(shape, dtype=bool)
+
+    def update(self, verts, value=True):
+        """Draw (value True) or erase (value False) a lasso polygon.
+
+        Only bins within the bounding box of the polygon are tested, the mask
+        is updated in place.
+
+        Parameters
+        ----------
+        verts : list of (x, y) tuples
+            Lasso vertices in histogram data coordinates.
+        value : bool
+            New value of the bins inside the polygon.
+
+        """
+        verts = np.asarray(verts, dtype=np.float64)
+        if verts.ndim != 2 or len(verts) == 0:
+            return
+        # bounding box (columns x, rows y) with margin for the radius
+        margin = self.radius + 1
+        x0 = max(int(np.floor(verts[:, 0].min() - margin)), 0)
+        x1 = min(int(np.ceil(verts[:, 0].max() + margin)) + 1, self.shape[1])
+        y0 = max(int(np.floor(verts[:, 1].min() - margin)), 0)
+        y1 = min(int(np.ceil(verts[:, 1].max() + margin)) + 1, self.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return
+        xv, yv = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
+        pix = np.column_stack((xv.ravel(), yv.ravel()))
+        inside = Path(verts).contains_points(pix, radius=self.radius)
+        self.mask[y0:y1, x0:x1][inside.reshape(xv.shape)] = value
+
+    def reset(self):
+        """Clear the selection."""
+        self.mask[...] = False
@@ -1,31 +1,167 @@
 #!/usr/bin/env python
 """Save 2D histogram image without displaying GUI."""
 
-from __future__ import print_function
+from __future__ import division, print_function
 import os
+import copy
 import numpy as np
-import segmentator.config as cfg
-from segmentator.utils import truncate_range, scale_range, check_data
-from segmentator.utils import set_gradient_magnitude, prep_2D_hist
-from nibabel import load
-
-# load data
-nii = load(cfg.filename)
-basename = nii.get_filename().split(os.extsep, 1)[0]
-
-# data processing
-orig, _ = check_data(nii.get_data(), cfg.force_original_precision)
-orig, _, _ = truncate_range(orig, percMin=cfg.perc_min, percMax=cfg.perc_max)
-orig = scale_range(orig, scale_factor=cfg.scale, delta=0.0001)
-gra = set_gradient_magnitude(orig, cfg.gramag)
-
-# reshape ima (a bit more intuitive for voxel-wise operations)
-ima = np.ndarray.flatten(orig)
-gra = np.ndarray.flatten(gra)
-
-counts, _, _, _, _, _ = prep_2D_hist(ima, gra, discard_zeros=cfg.discard_zeros)
-outName = '{}_volHist_pcMax{}_pcMin{}_sc{}'.format(
-    basename, cfg.perc_max, cfg.perc_min, int(cfg.scale))
-outName = outName.replace('.', 'pt')
-np.save(outName, counts)
-print('  Image saved as:\n {}'.format(outName))
+from multiprocessing import Pool, cpu_count
+from segmentator.pipeline import pipeline_params, preprocess
+
+
+class hist2d_group:
+    """Streamed sum, mean and log-mean of 2D histogram counts."""
+
+    def __init__(self):
+        """Initialize variables."""
+        self.nr_subjects = 0
+        self.sum = np.zeros((0, 0), dtype=np.int64)
+        self.log_sum = np.zeros((0, 0), dtype=np.float64)
+
+    def add(self, counts, d_min=0):
+        """Add the counts of one subject.
+
+        Parameters
+        ----------
+        counts : np.ndarray, shape(nr_bins, nr_bins)
+            2D histogram counts (see utils.prep_2D_hist).
+        d_min : float
+            Scaled intensity of the first bin. Counts of subjects with
+            different bin ranges are aligned with it.
+
+        """
+        start = int(d_min)
+        stop = start + counts.shape[0]
+        if stop > self.sum.shape[0]:  # grow, new bins are empty so far
+            self.sum = np.pad(self.sum, (0, stop - self.sum.shape[0]),
+                              mode='constant')
+            self.log_sum = np.pad(self.log_sum,
+                                  (0, stop - self.log_sum.shape[0]),
+                                  mode='constant')
+        self.sum[start:stop, start:stop] += counts
+        self.log_sum[start:stop, start:stop] += np.log10(counts + 1)
+        self.nr_subjects += 1
+
+    def mean(self):
+        """Mean counts over subjects."""
+        return self.sum / max(self.nr_subjects, 1)
+
+    def log_mean(self):
+        """Mean of log10(counts + 1) over subjects."""
+        return self.log_sum / max(self.nr_subjects, 1)
+
+
+def output_basename(filename, params):
+    """Name of the saved counts of an image, without extension."""
+    dirname, basename = os.path.split(filename)
+    basename = basename.split(os.extsep, 1)[0]
+    suffix = '_volHist_pcMax{}_pcMin{}_sc{}'.format(
+        params.perc_max, params.perc_min, int(params.scale))
+    return os.path.join(dirname, basename + suffix.replace('.', 'pt'))
+
+
+def save_counts(filename, params=None):
+    """Save 2D histogram counts of an image as a numpy file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a nifti file.
+    params : pipeline_params, optional
+        Pipeline parameters. Defaults are taken from segmentator.config.
+
+    Returns
+    -------
+    outName : str
+        Path of the saved counts, without the .npy extension.
+    counts : np.ndarray
+        2D histogram counts.
+    d_min : float
+        Scaled intensity of the first bin.
+
+    """
+    params = pipeline_params() if params is None else params
+    # read the input slab by slab if approximate percentiles are allowed,
+    # only counts are needed, so neither index nor cache entries are made
+    volume = preprocess(filename, params, read_slabs=True, index=False,
+                        write_cache=False)
+    outName = output_basename(filename, params)
+    np.save(outName, volume.counts)
+    return outName, volume.counts, volume.d_min
+
+
+def save_counts_task(task):
+    """Call save_counts, report errors instead of raising them."""
+    try:
+        return task[0], save_counts(*task), ''
+    except Exception as error:  # continue with other images
+        return task[0], None, '{}: {}'.format(type(error).__name__, error)
+
+
+def main(filenames, params=None, nr_processes=0, group_name=None):
+    """Save 2D histogram counts of images and of the group.
+
+    Parameters
+    ----------
+    filenames : str or list of str
+        Paths to nifti files.
+    params : pipeline_params, optional
+        Pipeline parameters. Defaults are taken from segmentator.config.
+    nr_processes : int
+        Number of images processed in parallel, 0 uses all available cores.
+    group_name : str, optional
+        Path prefix of the group sum, mean and log-mean counts. Only saved
+        for more than one image. Defaults to 'group' in the common directory
+        of the inputs.
+
+    Returns
+    -------
+    outNames : list of str
+        Paths of the saved counts, without the .npy extension.
+
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    params = pipeline_params() if params is None else copy.copy(params)
+    if nr_processes < 1:
+        nr_processes = cpu_count()
+    nr_processes = max(1, min(nr_processes, len(filenames)))
+    if params.nr_workers < 1:
+        # share the cores between processes instead of oversubscribing
+        params.nr_workers = max(1, cpu_count() // nr_processes)
+
+    tasks = [(filename, params) for filename in filenames]
+    if nr_processes == 1:
+        results = (save_counts_task(task) for task in tasks)
+    else:
+        pool = Pool(nr_processes, maxtasksperchild=8)
+        results = pool.imap_unordered(save_counts_task, tasks)
+
+    # counts are added to the group as they arrive, one image at a time
+    group, outNames = hist2d_group(), []
+    try:
+        for filename, result, error in results:
+            if error:
+                print('  {} failed: {}'.format(filename, error))
+                continue
+            outName, counts, d_min = result
+            group.add(counts, d_min)
+            outNames.append(outName)
+            print('  Image saved as:\n {}'.format(outName))
+    finally:
+        if nr_processes > 1:
+            pool.terminate()
+            pool.join()
+
+    if len(filenames) > 1 and group.nr_subjects > 0:
+        if group_name is None:
+            group_name = os.path.join(os.path.commonpath(
+                [os.path.dirname(os.path.abspath(f)) for f in filenames]),
+                'group')
+        groupName = output_basename(group_name, params)
+        np.save(groupName + '_sum', group.sum)
+        np.save(groupName + '_mean', group.mean())
+        np.save(groupName + '_logmean', group.log_mean())
+        print('  Group counts of {} images saved as:\n {}_[sum, mean, '
+              'logmean]'.format(group.nr_subjects, groupName))
+    return outNames
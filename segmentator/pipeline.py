@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""Segmentator pipeline that can be used without the GUI.
+
+Loading, preprocessing, 2D histogram, mapping of histogram selections to the
+image and export are functions with explicit parameter objects. One process
+can handle many images in a row, for example:
+
+    from segmentator.pipeline import pipeline_params, preprocess
+    from segmentator.pipeline import map_selection, export_labels
+    params = pipeline_params(gramag='scharr', scale=400)
+    for filename in filenames:
+        volume = preprocess(filename, params)
+        labels = map_selection(volume, volHistMask)
+        export_labels(volume, labels, 'labels.nii.gz')
+
+"""
+
+from __future__ import division, print_function
+import numpy as np
+import segmentator.config as cfg
+from nibabel import load, save, Nifti1Image
+from segmentator.utils import load_data, volume_stats
+from segmentator.utils import truncate_range, scale_range, truncate_and_scale
+from segmentator.utils import set_gradient_magnitude, prep_2D_hist
+from segmentator.utils import invert_ima_to_2D_hist_map
+from segmentator.utils import relabel_2D_hist_mask, map_2D_hist_to_vol
+from segmentator.cache_utils import preprocessing_params, preprocessing_key
+from segmentator.cache_utils import session_key, load_session, save_session
+
+
+class pipeline_params:
+    """Parameters of the pipeline.
+
+    Attributes have the same names and meaning as in segmentator.config,
+    which holds the command line arguments. Defaults are the values in
+    segmentator.config at the time the object is created.
+    """
+
+    names = ['gramag', 'deriche_alpha', 'perc_min', 'perc_max',
+             'approx_percentiles', 'valmin', 'valmax', 'scale',
+             'discard_zeros', 'force_original_precision', 'nr_workers',
+             'use_cache', 'cache_dir', 'cache_size', 'gramag_options']
+
+    def __init__(self, **kwargs):
+        """Initialize variables."""
+        for name in self.names:
+            setattr(self, name, getattr(cfg, name))
+        for name, value in kwargs.items():
+            if name not in self.names:
+                raise TypeError('Unknown pipeline parameter: {}'.format(name))
+            setattr(self, name, value)
+
+    def use_value_range(self):
+        """Truncate with valmin and valmax instead of percentiles."""
+        return not (np.isnan(self.valmin) or np.isnan(self.valmax))
+
+
+class preprocessed_volume:
+    """Preprocessed image, its 2D histogram and the bin to voxel index."""
+
+    def __init__(self, nii, orig, pMin, pMax, counts, d_min, d_max, nr_bins,
+                 bin_edges, ima2volHistMap, binVoxels, binOffsets, imaMin,
+                 imaMax, gra=None):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        nii : nibabel image
+            Input image, used for header and affine in exports.
+        orig : np.ndarray
+            Truncated and scaled image.
+        pMin, pMax : float
+            Truncation thresholds in original intensities.
+        counts, d_min, d_max, nr_bins, bin_edges, ima2volHistMap
+            See utils.prep_2D_hist.
+        binVoxels, binOffsets : np.ndarray or None
+            See utils.invert_ima_to_2D_hist_map. None if the index is not
+            built.
+        imaMin, imaMax : float
+            Range of the scaled image.
+        gra : np.ndarray, optional
+            Gradient magnitude image.
+
+        """
+        self.nii = nii
+        self.orig = orig
+        self.dims = orig.shape
+        self.pMin, self.pMax = pMin, pMax
+        self.counts = counts
+        self.d_min, self.d_max = d_min, d_max
+        self.nr_bins = int(nr_bins)
+        self.bin_edges = bin_edges
+        self.ima2volHistMap = ima2volHistMap
+        self.binVoxels, self.binOffsets = binVoxels, binOffsets
+        self.imaMin, self.imaMax = imaMin, imaMax
+        self.gra = gra
+
+    def session_arrays(self):
+        """Arrays to be stored in the session cache."""
+        return dict(orig=self.orig, ima2volHistMap=self.ima2volHistMap,
+                    counts=self.counts, bin_edges=self.bin_edges,
+                    binVoxels=self.binVoxels, binOffsets=self.binOffsets,
+                    limits=[self.pMin, self.pMax, self.d_min, self.d_max,
+                            self.nr_bins, self.imaMin, self.imaMax])
+
+
+def preprocess(filename, params=None, read_slabs=False, keep_gradient=False,
+               index=True, write_cache=True):
+    """Load, truncate and scale an image and compute its 2D histogram.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a nifti file.
+    params : pipeline_params, optional
+        Pipeline parameters. Defaults are taken from segmentator.config.
+    read_slabs : bool
+        With approximate percentiles, read the input slab by slab instead of
+        loading it at once.
+    keep_gradient : bool
+        Keep the gradient magnitude image in the output. The session cache
+        is not used in this case.
+    index : bool
+        Build the bin to voxel index, which is needed to map selections to
+        the image. Without it, only the 2D histogram is usable and the
+        session is not stored in the cache.
+    write_cache : bool
+        Store the session and the gradient magnitude in the cache, so that
+        the GUI can start faster next time. Disable it when many images are
+        processed once, their arrays would only evict other cache entries.
+        Cached arrays are read either way.
+
+    Returns
+    -------
+    volume : preprocessed_volume
+
+    """
+    params = pipeline_params() if params is None else params
+    nii = load(filename)
+    read_slabs = (read_slabs and params.approx_percentiles
+                  and not params.use_value_range())
+    if params.use_value_range():
+        prep_params = preprocessing_params(
+            params, perc_min=None, perc_max=None, approx_percentiles=None,
+            valmin=params.valmin, valmax=params.valmax)
+    elif read_slabs:
+        prep_params = preprocessing_params(
+            params, force_original_precision=None, read_slabs=True)
+    else:
+        prep_params = preprocessing_params(params)
+    key = preprocessing_key(filename, prep_params, params)
+
+    # Reuse preprocessed arrays of an earlier session with the same inputs
+    sessionKey = None
+    if not keep_gradient:
+        sessionKey = session_key(key, params.gramag, params)
+    session = load_session(sessionKey, params)
+    if session is not None:
+        print('Preprocessed data is loaded from cache.')
+        pMin, pMax, d_min, d_max, nr_bins, imaMin, imaMax = session['limits']
+        return preprocessed_volume(
+            nii, session['orig'], pMin, pMax, session['counts'], d_min,
+            d_max, nr_bins, session['bin_edges'], session['ima2volHistMap'],
+            session['binVoxels'], session['binOffsets'], imaMin, imaMax)
+
+    if read_slabs:
+        orig, pMin, pMax = truncate_and_scale(
+            nii.dataobj, percMin=params.perc_min, percMax=params.perc_max,
+            scale_factor=params.scale, delta=0.0001)
+        stats = volume_stats(orig)
+    else:
+        orig, _ = load_data(nii, params.force_original_precision)
+        # Compute masks and extrema once, shared by the preprocessing steps
+        stats = volume_stats(orig)
+        if params.use_value_range():
+            # TODO: integrate this into truncate range function
+            np.clip(orig, params.valmin, params.valmax, out=orig,
+                    casting='unsafe')
+            stats.update_zero_mask()
+            pMin, pMax = params.valmin, params.valmax
+        else:
+            orig, pMin, pMax = truncate_range(
+                orig, percMin=params.perc_min, percMax=params.perc_max,
+                stats=stats, approximate=params.approx_percentiles)
+        orig = scale_range(orig, scale_factor=params.scale, delta=0.0001,
+                           stats=stats)
+    gra = set_gradient_magnitude(orig, params.gramag, stats=stats, key=key,
+                                 params=params, write_cache=write_cache)
+
+    # Reshape for voxel-wise operations (views, no copies)
+    counts, d_min, d_max, nr_bins, bin_edges, ima2volHistMap = prep_2D_hist(
+        orig.ravel(), gra.ravel(), discard_zeros=params.discard_zeros,
+        stats=stats)
+    binVoxels, binOffsets = None, None
+    if index:
+        binVoxels, binOffsets = invert_ima_to_2D_hist_map(ima2volHistMap,
+                                                          nr_bins)
+    volume = preprocessed_volume(
+        nii, orig, pMin, pMax, counts, d_min, d_max, nr_bins, bin_edges,
+        ima2volHistMap, binVoxels, binOffsets, orig.min(), orig.max(),
+        gra=gra if keep_gradient else None)
+    if index and write_cache:
+        save_session(sessionKey, params, **volume.session_arrays())
+    return volume
+
+
+def map_selection(volume, volHistMask, discard_zeros=True):
+    """Map a volume histogram selection to a label volume.
+
+    Parameters
+    ----------
+    volume : preprocessed_volume
+        Preprocessed image.
+    volHistMask : np.ndarray, shape(nr_bins, nr_bins)
+        Volume histogram mask, e.g. a binary sector mask or ncut labels.
+    discard_zeros : bool
+        Leave out voxels in bin 0 (image zeros).
+
+    Returns
+    -------
+    labels : np.ndarray
+        Label volume with the shape of the image.
+
+    """
+    volHistLabels = relabel_2D_hist_mask(volHistMask, discard_zeros)
+    return map_2D_hist_to_vol(volume.binVoxels, volume.binOffsets,
+                              volHistLabels, volume.dims,
+                              dtype=volHistLabels.dtype)
+
+
+def export_labels(volume, labels, filename):
+    """Save a label volume as a nifti file.
+
+    Parameters
+    ----------
+    volume : preprocessed_volume
+        Preprocessed image, header and affine are taken from it.
+    labels : np.ndarray
+        Label volume with the shape of the image.
+    filename : str
+        Output path.
+
+    """
+    new_image = Nifti1Image(labels, header=volume.nii.header,
+                            affine=volume.nii.affine)
+    new_image.set_data_dtype(labels.dtype)  # do not inherit input type
+    save(new_image, filename)
@@ -10,37 +10,28 @@ print("Matplotlib backend: {}".format(matplotlib.rcParams['backend']))
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 from matplotlib.widgets import Slider, Button, LassoSelector
-from matplotlib import path
-from nibabel import load
-from segmentator.utils import map_ima_to_2D_hist, prep_2D_hist
-from segmentator.utils import truncate_range, scale_range, check_data
-from segmentator.utils import set_gradient_magnitude
 from segmentator.utils import export_gradient_magnitude_image
-from segmentator.gui_utils import sector_mask, responsiveObj
+from segmentator.pipeline import pipeline_params, preprocess
+from segmentator.gui_utils import sector_mask, lasso_mask
+from segmentator.gui_utils import responsiveObj, plot_2D_hist
 from segmentator.config_gui import palette, axcolor, hovcolor
 
 #
 """Data Processing"""
-nii = load(cfg.filename)
-orig, dims = check_data(nii.get_data(), cfg.force_original_precision)
-# Save min and max truncation thresholds to be used in axis labels
-if np.isnan(cfg.valmin) or np.isnan(cfg.valmax):
-    orig, pMin, pMax = truncate_range(orig, percMin=cfg.perc_min,
-                                      percMax=cfg.perc_max)
-else:  # TODO: integrate this into truncate range function
-    orig[orig < cfg.valmin] = cfg.valmin
-    orig[orig > cfg.valmax] = cfg.valmax
-    pMin, pMax = cfg.valmin, cfg.valmax
-
-# Continue with scaling the original truncated image and recomputing gradient
-orig = scale_range(orig, scale_factor=cfg.scale, delta=0.0001)
-gra = set_gradient_magnitude(orig, cfg.gramag)
+volume = preprocess(cfg.filename, pipeline_params(),
+                    keep_gradient=cfg.export_gramag)
 if cfg.export_gramag:
-    export_gradient_magnitude_image(gra, nii.get_filename(), cfg.gramag,
-                                    nii.affine)
-# Reshape for voxel-wise operations
-ima = np.copy(orig.flatten())
-gra = gra.flatten()
+    export_gradient_magnitude_image(volume.gra, cfg.filename, cfg.gramag,
+                                    volume.nii.affine)
+nii, orig, dims = volume.nii, volume.orig, volume.dims
+# Save min and max truncation thresholds to be used in axis labels
+pMin, pMax = volume.pMin, volume.pMax
+counts, d_min, d_max = volume.counts, volume.d_min, volume.d_max
+nr_bins, bin_edges = volume.nr_bins, volume.bin_edges
+ima2volHistMap = volume.ima2volHistMap
+binVoxels, binOffsets = volume.binVoxels, volume.binOffsets
+imaMin, imaMax = volume.imaMin, volume.imaMax
+volume = None
 
 #
 """Plots"""
@@ -48,9 +39,7 @@ print("Preparing GUI...")
 # Plot 2D histogram
 fig = plt.figure(facecolor='0.775')
 ax = fig.add_subplot(121)
-
-counts, volHistH, d_min, d_max, nr_bins, bin_edges \
-    = prep_2D_hist(ima, gra, discard_zeros=cfg.discard_zeros)
+volHistH = plot_2D_hist(ax, counts, bin_edges)
 
 # Set x-y axis range to the same (x-axis range)
 ax.set_xlim(d_min, d_max)
@@ -66,11 +55,11 @@ fig.colorbar(volHistH, fraction=0.046, pad=0.04)  # magical scaling
 # Plot 3D ima by default
 ax2 = fig.add_subplot(122)
 sliceNr = int(0.5*dims[2])
-imaSlcH = ax2.imshow(orig[:, :, sliceNr], cmap=plt.cm.gray, vmin=ima.min(),
-                     vmax=ima.max(), interpolation='none',
+imaSlcH = ax2.imshow(orig[:, :, sliceNr], cmap=plt.cm.gray, vmin=imaMin,
+                     vmax=imaMax, interpolation='none',
                      extent=[0, dims[1], dims[0], 0], zorder=0)
 
-imaSlcMsk = np.ones(dims[0:2])
+imaSlcMsk = np.ones(dims[0:2], dtype=np.uint8)
 imaSlcMskH = ax2.imshow(imaSlcMsk, cmap=palette, vmin=0.1,
                         interpolation='none', alpha=0.5,
                         extent=[0, dims[1], dims[0], 0], zorder=1)
@@ -78,7 +67,7 @@ imaSlcMskH = ax2.imshow(imaSlcMsk, cmap=palette, vmin=0.1,
 # Adjust subplots on figure
 bottom = 0.30
 fig.subplots_adjust(bottom=bottom)
-fig.canvas.set_window_title(nii.get_filename())
+fig.canvas.manager.set_window_title(nii.get_filename())
 plt.axis('off')
 
 #
@@ -94,7 +83,7 @@ volHistMaskH, volHistMask = sectorObj.draw(ax, cmap=palette, alpha=0.2,
                                            extent=[0, nr_bins, 0, nr_bins])
 
 # Initiate a flexible figure object, pass to it useful properties
-idxLasso = np.zeros(nr_bins*nr_bins, dtype=bool)
+lassoObj = lasso_mask((nr_bins, nr_bins))
 lassoSwitchCount = 0
 lassoErase = 1  # 1 for drawing, 0 for erasing
 flexFig = responsiveObj(figure=ax.figure, axes=ax.axes, axes2=ax2.axes,
@@ -104,18 +93,18 @@ flexFig = responsiveObj(figure=ax.figure, axes=ax.axes, axes2=ax2.axes,
                         sliceNr=sliceNr,
                         imaSlcH=imaSlcH,
                         imaSlcMsk=imaSlcMsk, imaSlcMskH=imaSlcMskH,
+                        volHistH=volHistH,
                         volHistMask=volHistMask, volHistMaskH=volHistMaskH,
-                        contains=volHistMaskH.contains,
+                        contains=sectorObj.contains,
                         counts=counts,
-                        idxLasso=idxLasso,
+                        lassoObj=lassoObj,
                         lassoSwitchCount=lassoSwitchCount,
                         lassoErase=lassoErase)
 
 # Make the figure responsive to clicks
 flexFig.connect()
-ima2volHistMap = map_ima_to_2D_hist(xinput=ima, yinput=gra, bins_arr=bin_edges)
 flexFig.invHistVolume = np.reshape(ima2volHistMap, dims)
-ima, gra = None, None
+flexFig.binVoxels, flexFig.binOffsets = binVoxels, binOffsets
 
 #
 """Sliders and Buttons"""
@@ -234,19 +223,13 @@ def lassoSwitch(event):
         bLassoErase.label.set_visible(False)
         bLassoErase.ax.axis('off')
 
-# Pixel coordinates
-pix = np.arange(nr_bins)
-xv, yv = np.meshgrid(pix, pix)
-pix = np.vstack((xv.flatten(), yv.flatten())).T
-
 
 def onselect(verts):
     """Lasso related."""
-    global pix
-    p = path.Path(verts)
-    newLasIdx = p.contains_points(pix, radius=1.5)  # New lasso indices
-    flexFig.idxLasso[newLasIdx] = flexFig.lassoErase  # Update lasso indices
-    flexFig.remapMsks()  # Update volume histogram mask
+    # draw or erase the polygon in the lasso bin mask
+    with flexFig.remapLock:  # also read by the motion worker
+        flexFig.lassoObj.update(verts, flexFig.lassoErase)
+        flexFig.remapMsks()  # Update volume histogram mask
     flexFig.updatePanels(update_slice=False, update_rotation=True,
                          update_extent=True)
 
@@ -12,17 +12,14 @@ matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm, ListedColormap, BoundaryNorm
 from matplotlib.widgets import Slider, Button, RadioButtons
-from nibabel import load
-from segmentator.utils import map_ima_to_2D_hist, prep_2D_hist
-from segmentator.utils import truncate_range, scale_range, check_data
-from segmentator.utils import set_gradient_magnitude
+from segmentator.utils import label_dtype
 from segmentator.utils import export_gradient_magnitude_image
-from segmentator.gui_utils import responsiveObj
+from segmentator.pipeline import pipeline_params, preprocess
+from segmentator.gui_utils import responsiveObj, plot_2D_hist
 from segmentator.config_gui import palette, axcolor, hovcolor
 
 #
 """Load Data"""
-nii = load(cfg.filename)
 ncut_labels = np.load(cfg.ncut)
 
 # transpose the labels
@@ -45,6 +42,7 @@ for ind in np.arange(ncut_labels.shape[2]):
     counter = counter + nrUniqueVals
     ncut_labels[:, :, ind] = tmp2
 lMax = np.max(ncut_labels)
+ncut_labels = ncut_labels.astype(label_dtype(lMax))
 
 orig_ncut_labels = ncut_labels.copy()
 ima_ncut_labels = ncut_labels.copy()
@@ -52,19 +50,22 @@ ima_ncut_labels = ncut_labels.copy()
 
 #
 """Data Processing"""
-orig, dims = check_data(nii.get_data(), cfg.force_original_precision)
-# Save min and max truncation thresholds to be used in axis labels
-orig, pMin, pMax = truncate_range(orig, percMin=cfg.perc_min,
-                                  percMax=cfg.perc_max)
-# Continue with scaling the original truncated image and recomputing gradient
-orig = scale_range(orig, scale_factor=cfg.scale, delta=0.0001)
-gra = set_gradient_magnitude(orig, cfg.gramag)
+volume = preprocess(cfg.filename, pipeline_params(),
+                    keep_gradient=cfg.export_gramag)
 if cfg.export_gramag:
-    export_gradient_magnitude_image(gra, nii.get_filename(), nii.affine)
-
-# Reshape ima (more intuitive for voxel-wise operations)
-ima = np.ndarray.flatten(orig)
-gra = np.ndarray.flatten(gra)
+    export_gradient_magnitude_image(volume.gra, cfg.filename, cfg.gramag,
+                                    volume.nii.affine)
+nii, orig, dims = volume.nii, volume.orig, volume.dims
+# Save min and max truncation thresholds to be used in axis labels
+pMin, pMax = volume.pMin, volume.pMax
+counts, d_min, d_max = volume.counts, volume.d_min, volume.d_max
+nr_bins, bin_edges = volume.nr_bins, volume.bin_edges
+ima2volHistMap = volume.ima2volHistMap
+binVoxels, binOffsets = volume.binVoxels, volume.binOffsets
+imaMin, imaMax = volume.imaMin, volume.imaMax
+# Reshape ima (more intuitive for voxel-wise operations, views no copies)
+ima = orig.ravel()
+volume = None
 
 #
 """Plots"""
@@ -72,9 +73,7 @@ print("Preparing GUI...")
 # Plot 2D histogram
 fig = plt.figure(facecolor='0.775')
 ax = fig.add_subplot(121)
-
-counts, volHistH, d_min, d_max, nr_bins, bin_edges \
-    = prep_2D_hist(ima, gra, discard_zeros=cfg.discard_zeros)
+volHistH = plot_2D_hist(ax, counts, bin_edges)
 
 ax.set_xlim(d_min, d_max)
 ax.set_ylim(d_min, d_max)
@@ -114,9 +113,9 @@ volHistMaskH = ax.imshow(volHistMask, interpolation='none',
 ax2 = fig.add_subplot(122)
 sliceNr = int(0.5*dims[2])
 imaSlcH = ax2.imshow(orig[:, :, sliceNr], cmap=plt.cm.gray,
-                     vmin=ima.min(), vmax=ima.max(), interpolation='none',
+                     vmin=imaMin, vmax=imaMax, interpolation='none',
                      extent=[0, dims[1], dims[0], 0])
-imaSlcMsk = np.zeros(dims[0:2])*total_labels[1]
+imaSlcMsk = np.zeros(dims[0:2], dtype=ncut_labels.dtype)
 imaSlcMskH = ax2.imshow(imaSlcMsk, interpolation='none', alpha=0.5,
                         cmap=ncut_palette, vmin=np.min(ncut_labels)+1,
                         vmax=lMax,
@@ -125,7 +124,7 @@ imaSlcMskH = ax2.imshow(imaSlcMsk, interpolation='none', alpha=0.5,
 # Adjust subplots on figure
 bottom = 0.30
 fig.subplots_adjust(bottom=bottom)
-fig.canvas.set_window_title(nii.get_filename())
+fig.canvas.manager.set_window_title(nii.get_filename())
 plt.axis('off')
 
 
@@ -138,6 +137,7 @@ flexFig = responsiveObj(figure=ax.figure, axes=ax.axes, axes2=ax2.axes,
                         sliceNr=sliceNr,
                         imaSlcH=imaSlcH,
                         imaSlcMsk=imaSlcMsk, imaSlcMskH=imaSlcMskH,
+                        volHistH=volHistH,
                         volHistMask=volHistMask,
                         volHistMaskH=volHistMaskH,
                         pltMap=pltMap, pltMapH=pltMapH,
@@ -149,8 +149,8 @@ flexFig = responsiveObj(figure=ax.figure, axes=ax.axes, axes2=ax2.axes,
 # Make the figure responsive to clicks
 flexFig.connect()
 # Get mapping from image slice to volume histogram
-ima2volHistMap = map_ima_to_2D_hist(xinput=ima, yinput=gra, bins_arr=bin_edges)
 flexFig.invHistVolume = np.reshape(ima2volHistMap, dims)
+flexFig.binVoxels, flexFig.binOffsets = binVoxels, binOffsets
 
 # %%
 """Sliders and Buttons"""
@@ -0,0 +1,143 @@
+"""Volume histogram selections saved to and loaded from files.
+
+A selection file (.npz) holds the bin mask or labels, the geometric
+parameters of the sector and lasso it was drawn with, and the preprocessing
+parameters that define the bins. Binary masks are bit-packed.
+"""
+
+from __future__ import division, print_function
+import json
+import numpy as np
+
+# Increase when the layout of selection files changes
+SELECTION_VERSION = 1
+
+# Pipeline parameters that change which voxels fall into which bin
+SELECTION_PARAMS = ['gramag', 'deriche_alpha', 'perc_min', 'perc_max',
+                    'approx_percentiles', 'valmin', 'valmax', 'scale',
+                    'discard_zeros', 'force_original_precision']
+
+
+def save_selection(filename, volHistMask, params=None, sector=None,
+                   idxLasso=None):
+    """Save a volume histogram selection.
+
+    Parameters
+    ----------
+    filename : str
+        Output path, '.npz' is appended if missing.
+    volHistMask : np.ndarray, shape(nr_bins, nr_bins)
+        Binary mask or labels of the volume histogram.
+    params : pipeline_params or module, optional
+        Pipeline parameters the selection was made with, for example
+        segmentator.config.
+    sector : sector_mask, optional
+        Sector the mask was drawn with.
+    idxLasso : np.ndarray, optional
+        Boolean lasso selection over the flattened bins.
+
+    Returns
+    -------
+    filename : str
+        Path of the saved file.
+
+    """
+    volHistMask = np.asarray(volHistMask)
+    if not filename.endswith('.npz'):
+        filename += '.npz'
+    arrays = dict(version=SELECTION_VERSION,
+                  shape=np.array(volHistMask.shape))
+    if volHistMask.dtype == bool or volHistMask.max() <= 1:
+        arrays['mask_bits'] = np.packbits(volHistMask.ravel() > 0)
+    else:
+        arrays['labels'] = volHistMask
+    if sector is not None:
+        arrays['sector'] = np.array([sector.cx, sector.cy, sector.radius,
+                                     sector.tmin, sector.tmax])
+    if idxLasso is not None:
+        arrays['lasso_bits'] = np.packbits(np.ravel(idxLasso))
+    if params is not None:
+        arrays['params'] = json.dumps(
+            {name: getattr(params, name) for name in SELECTION_PARAMS})
+    np.savez(filename, **arrays)
+    return filename
+
+
+def load_selection(filename):
+    """Load a volume histogram selection.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a selection file (.npz), or to a numpy file (.npy) with a
+        2D mask or labels, e.g. labels exported from the ncut GUI.
+
+    Returns
+    -------
+    volHistMask : np.ndarray, shape(nr_bins, nr_bins)
+        Binary mask (bool) or labels of the volume histogram.
+    info : dict
+        'sector' (centre x, centre y, radius, start and stop angles in
+        radians), 'idxLasso' (boolean, flattened bins) and 'params'
+        (preprocessing parameters), None where not saved.
+
+    """
+    info = dict(sector=None, idxLasso=None, params=None)
+    if not filename.endswith('.npz'):
+        volHistMask = np.load(filename)
+    else:
+        with np.load(filename) as data:
+            if int(data['version']) > SELECTION_VERSION:
+                raise ValueError('Selection file version {} is not supported'
+                                 ', update segmentator.'.format(
+                                     int(data['version'])))
+            shape = tuple(data['shape'])
+            nr_bins = int(np.prod(shape))
+            if 'mask_bits' in data:
+                volHistMask = np.unpackbits(
+                    data['mask_bits'], count=nr_bins).astype(bool)
+                volHistMask = volHistMask.reshape(shape)
+            else:
+                volHistMask = data['labels']
+            if 'sector' in data:
+                info['sector'] = tuple(data['sector'].tolist())
+            if 'lasso_bits' in data:
+                info['idxLasso'] = np.unpackbits(
+                    data['lasso_bits'], count=nr_bins).astype(bool)
+            if 'params' in data:
+                info['params'] = json.loads(str(data['params']))
+    if volHistMask.ndim != 2 or volHistMask.shape[0] != volHistMask.shape[1]:
+        raise ValueError('Selection has to be a square 2D array, got shape '
+                         '{}.'.format(volHistMask.shape))
+    return volHistMask, info
+
+
+def use_selection_params(params, stored, gramag=None):
+    """Set the preprocessing parameters stored in a selection.
+
+    Parameters
+    ----------
+    params : pipeline_params
+        Pipeline parameters, updated in place.
+    stored : dict
+        Parameters of the selection (info['params'] of load_selection).
+    gramag : str, optional
+        Gradient magnitude option used if the selection was made with a
+        gradient magnitude image. Such an image belongs to the subject of
+        the GUI session and is not applied to other images.
+
+    Returns
+    -------
+    params : pipeline_params
+
+    """
+    for name, value in stored.items():
+        if name == 'gramag' and value not in params.gramag_options:
+            if gramag is None:
+                raise ValueError(
+                    'The selection was made with the gradient magnitude '
+                    'image {}, which only fits that subject. Set the gradient '
+                    'magnitude option (--gramag) explicitly.'.format(value))
+            value = gramag
+        setattr(params, name, value)
+    return params
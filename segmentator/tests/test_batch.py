@@ -0,0 +1,54 @@
+"""Test batch processing."""
+
+import numpy as np
+from segmentator.pipeline import pipeline_params, preprocess, map_selection
+from segmentator.batch import run_batch, write_summary
+from nibabel import load, save, Nifti1Image
+
+
+def test_run_batch(tmpdir):
+    """Test applying one selection to several images."""
+    # Given
+    filenames = []
+    for i in range(3):
+        data = np.random.random((8, 9, 10)).astype(np.float32)
+        filenames.append(str(tmpdir.join('sub-{}.nii'.format(i))))
+        save(Nifti1Image(data, np.eye(4)), filenames[-1])
+    filenames.append(str(tmpdir.join('missing.nii')))
+    params = pipeline_params(gramag='numpy', scale=50, use_cache=False)
+    volHistMask = np.zeros((50, 50), dtype=np.uint8)
+    volHistMask[:, 10:30] = 1
+    volHistMask[:, 30:] = 2
+    # When
+    summaries = list(run_batch(filenames, volHistMask, params,
+                               out_dir=str(tmpdir.join('out')),
+                               nr_processes=2))
+    write_summary(summaries, str(tmpdir.join('summary.tsv')), 2)
+    # Then
+    summaries = {s['input']: s for s in summaries}
+    assert summaries[filenames[-1]]['error']
+    for filename in filenames[:-1]:
+        expected = map_selection(preprocess(filename, params), volHistMask)
+        labels = load(summaries[filename]['output']).get_fdata()
+        assert np.array_equal(labels, expected)
+        assert summaries[filename]['voxels'] == np.count_nonzero(expected)
+    with open(str(tmpdir.join('summary.tsv'))) as f:
+        assert len(f.readlines()) == 5
+
+
+def test_run_batch_cache(tmpdir):
+    """Test that batch runs do not fill the cache."""
+    # Given
+    filename = str(tmpdir.join('sub-0.nii'))
+    data = np.random.random((8, 9, 10)).astype(np.float32)
+    save(Nifti1Image(data, np.eye(4)), filename)
+    cache_dir = tmpdir.mkdir('cache')
+    params = pipeline_params(gramag='numpy', scale=50, use_cache=True,
+                             cache_dir=str(cache_dir))
+    volHistMask = np.ones((50, 50), dtype=bool)
+    # When
+    summaries = list(run_batch([filename], volHistMask, params,
+                               nr_processes=1))
+    # Then
+    assert not summaries[0]['error']
+    assert [f for f in cache_dir.visit() if f.ext == '.npy'] == []
@@ -0,0 +1,69 @@
+"""Test on-disk cache functions."""
+
+import os
+import numpy as np
+import segmentator.config as cfg
+from segmentator.cache_utils import array_cache, cache_key, file_hash
+from segmentator.cache_utils import load_session, save_session
+from segmentator.cache_utils import SESSION_ARRAYS
+
+
+def test_cache_key():
+    """Test that cache keys depend on all parameters."""
+    # Given
+    key = cache_key('abc', scale=400, perc_min=2.5)
+    # Then
+    assert key == cache_key('abc', perc_min=2.5, scale=400)
+    assert key != cache_key('abc', scale=400, perc_min=2.0)
+    assert key != cache_key('abd', scale=400, perc_min=2.5)
+
+
+def test_file_hash(tmpdir):
+    """Test memoized file hashes."""
+    # Given
+    path = str(tmpdir.join('data.bin'))
+    with open(path, 'wb') as f:
+        f.write(b'segmentator')
+    # When
+    digest = file_hash(path, cache_dir=str(tmpdir))
+    # Then
+    assert digest == file_hash(path)
+    assert os.path.isfile(str(tmpdir.join('file_hashes.json')))
+    with open(path, 'wb') as f:
+        f.write(b'segmentator!')
+    assert file_hash(path, cache_dir=str(tmpdir)) != digest
+
+
+def test_array_cache(tmpdir):
+    """Test memory-mapped loading and least recently used eviction."""
+    # Given
+    data = np.arange(100, dtype=np.float32)
+    cache = array_cache(str(tmpdir), max_size=2 * data.nbytes + 256)
+    # When
+    cache.save('a', data)
+    cache.save('b', data + 1)
+    os.utime(cache.path('a'), (0, 0))
+    os.utime(cache.path('b'), (1, 1))
+    loaded = cache.load('a')  # marks 'a' as recently used
+    cache.save('c', data + 2)
+    # Then
+    assert isinstance(loaded, np.memmap)
+    assert np.array_equal(loaded, data)
+    assert cache.load('b') is None
+    assert np.array_equal(cache.load('c'), data + 2)
+    assert cache.load('missing') is None
+
+
+def test_session(tmpdir, monkeypatch):
+    """Test storing and loading of preprocessed session arrays."""
+    # Given
+    monkeypatch.setattr(cfg, 'cache_dir', str(tmpdir))
+    arrays = {name: np.random.random(10) for name in SESSION_ARRAYS}
+    # When
+    save_session('abc', **arrays)
+    session = load_session('abc')
+    # Then
+    assert load_session('abd') is None
+    assert load_session(None) is None
+    for name in SESSION_ARRAYS:
+        assert np.array_equal(session[name], arrays[name])
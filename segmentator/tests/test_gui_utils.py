@@ -0,0 +1,190 @@
+"""Test GUI helpers that do not need a figure."""
+
+import time
+import threading
+import numpy as np
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as plt
+from matplotlib.path import Path
+from segmentator.gui_utils import sector_mask, lasso_mask, blit_manager
+from segmentator.gui_utils import motion_scheduler, responsiveObj
+from segmentator.utils import invert_ima_to_2D_hist_map
+from nibabel import load, save, Nifti1Image
+
+
+class event:
+    """Cursor position in data coordinates."""
+
+    def __init__(self, xdata, ydata):
+        """Initialize variables."""
+        self.xdata, self.ydata = xdata, ydata
+
+
+def test_sector_mask():
+    """Test bounding box rasterisation and point test of the sector."""
+    # Given
+    sector = sector_mask((60, 50), (20.5, 30.2), 17.3, (30, 250))
+    x, y = np.ogrid[:60, :50]
+    r2 = (x - sector.cx)**2 + (y - sector.cy)**2
+    theta = (np.arctan2(x - sector.cx, y - sector.cy) - sector.tmin)
+    expected = (r2 <= sector.radius**2) & (
+        theta % (2 * np.pi) <= sector.tmax - sector.tmin)
+    # When
+    mask = sector.binaryMask()
+    # Then
+    assert np.array_equal(mask, expected)
+    assert sector.binaryMask() is mask  # unchanged sector is not recomputed
+    for row, col in zip(*np.nonzero(expected)):
+        assert sector.contains(event(col + 0.5, row + 0.5))
+    for row, col in zip(*np.nonzero(~expected)):
+        assert not sector.contains(event(col + 0.5, row + 0.5))
+    assert not sector.contains(event(None, None))
+    sector.set_x(40)
+    assert not np.array_equal(sector.binaryMask(), mask)
+
+
+def test_lasso_mask():
+    """Test drawing and erasing lasso polygons in place."""
+    # Given
+    lasso = lasso_mask((40, 30))
+    mask = lasso.mask
+    square = [(5, 5), (15, 5), (15, 20), (5, 20)]
+    triangle = [(10, 10), (28, 10), (10, 35)]
+    xv, yv = np.meshgrid(np.arange(30), np.arange(40))
+    pix = np.column_stack((xv.ravel(), yv.ravel()))
+    expected = Path(square).contains_points(pix, radius=1.5)
+    expected[Path(triangle).contains_points(pix, radius=1.5)] = False
+    # When
+    lasso.update(square)
+    lasso.update(triangle, value=False)
+    # Then
+    assert lasso.mask is mask
+    assert np.array_equal(lasso.mask.ravel(), expected)
+    lasso.reset()
+    assert not lasso.mask.any()
+
+
+def test_blit_manager():
+    """Test that blitted updates look like full redraws."""
+    # Given
+    fig, ax = plt.subplots()
+    ax.imshow(np.random.random((20, 20)), cmap='gray')
+    maskH = ax.imshow(np.zeros((20, 20)), alpha=0.5, vmin=0, vmax=1)
+    blitter = blit_manager(fig.canvas, [maskH])
+    fig.canvas.draw()
+    # When
+    maskH.set_data(np.random.random((20, 20)) > 0.5)
+    blitter.update()
+    blitted = np.array(fig.canvas.buffer_rgba())
+    fig.canvas.draw()
+    # Then
+    assert maskH.get_animated()
+    assert np.array_equal(blitted, np.array(fig.canvas.buffer_rgba()))
+    plt.close(fig)
+
+
+def test_motion_scheduler():
+    """Test that only the latest request is computed and applied."""
+    # Given
+    fig = plt.figure()
+    computed, applied = [], []
+
+    def compute(state):
+        time.sleep(0.05)
+        computed.append(state)
+        return True
+
+    scheduler = motion_scheduler(fig.canvas, compute,
+                                 lambda: applied.append(computed[-1]))
+    # When
+    for state in range(10):
+        scheduler.submit(state)  # returns immediately
+    active = scheduler.timerActive
+    scheduler.wait()
+    scheduler.on_timer()  # next tick, nothing left to do
+    # Then
+    assert computed[-1] == 9
+    assert len(computed) < 10  # intermediate states are dropped
+    assert applied == [9]
+    assert active and not scheduler.timerActive
+    scheduler.submit(10)
+    assert scheduler.timerActive
+    scheduler.wait()
+    plt.close(fig)
+
+
+def make_flexFig(tmpdir, nr_bins=20, dims=(8, 6, 5)):
+    """Image browser of a random volume, set up as in segmentator_main."""
+    invHistVolume = np.random.randint(0, nr_bins**2, size=dims)
+    path = str(tmpdir.join('image.nii'))
+    save(Nifti1Image(np.random.random(dims).astype(np.float32), np.eye(4)),
+         path)
+    fig, (ax, ax2) = plt.subplots(1, 2)
+    sector = sector_mask((nr_bins, nr_bins), (10, 10), 8, (0, 360))
+    volHistMaskH, volHistMask = sector.draw(ax, extent=[0, nr_bins, 0,
+                                                        nr_bins])
+    imaSlcMsk = np.zeros(dims[:2], dtype=np.uint8)
+    flexFig = responsiveObj(
+        figure=fig, axes=ax, axes2=ax2, segmType='main',
+        orig=invHistVolume.astype(float), nii=load(path), sectorObj=sector,
+        lassoObj=lasso_mask((nr_bins, nr_bins)), nrBins=nr_bins, sliceNr=2,
+        imaSlcH=ax2.imshow(invHistVolume[:, :, 2]), imaSlcMsk=imaSlcMsk,
+        imaSlcMskH=ax2.imshow(imaSlcMsk), volHistMask=volHistMask,
+        volHistMaskH=volHistMaskH)
+    flexFig.invHistVolume = invHistVolume
+    flexFig.binVoxels, flexFig.binOffsets = invert_ima_to_2D_hist_map(
+        invHistVolume, nr_bins)
+    flexFig.remapMsks()
+    flexFig.updatePanels()
+    return flexFig
+
+
+def test_rotation_unchanged_remap(tmpdir):
+    """Test that updates without mask changes keep the rotation."""
+    # Given
+    flexFig = make_flexFig(tmpdir)
+    # When
+    flexFig.changeRotation(None)
+    changed = flexFig.remapMsks()
+    flexFig.updatePanels(update_slice=False, update_rotation=True)
+    # Then
+    assert not changed
+    assert flexFig.imaSlc.shape == (6, 8)
+    assert flexFig.imaSlcMsk.shape == flexFig.imaSlc.shape
+    assert np.array_equal(flexFig.imaSlcMsk,
+                          np.rot90(flexFig.imaSlcLabels))
+    plt.close(flexFig.figure)
+
+
+def test_motion_remap_without_lock(tmpdir):
+    """Test that results are applied while the worker computes masks."""
+    # Given
+    flexFig = make_flexFig(tmpdir)
+    remapCompute, started = flexFig.remapCompute, threading.Event()
+
+    def slow_compute(job):
+        started.set()
+        time.sleep(1.0)
+        remapCompute(job)
+
+    flexFig.remapCompute = slow_compute
+    scheduler = flexFig.motionScheduler
+    # When
+    scheduler.submit((12.0, 9.0))
+    started.wait()
+    scheduler.ready = True  # result of an earlier request
+    start = time.time()
+    scheduler.on_timer()
+    elapsed = time.time() - start
+    scheduler.wait()
+    # Then
+    assert elapsed < 0.5
+    assert (flexFig.sectorObj.cx, flexFig.sectorObj.cy) == (12.0, 9.0)
+    assert np.array_equal(flexFig.volHistMask,
+                          flexFig.sectorObj.binaryMask())
+    lut = flexFig.volHistMask.ravel().astype(np.uint8)
+    lut[0] = 0
+    assert np.array_equal(flexFig.imaSlcLabels,
+                          lut[flexFig.invHistVolume[:, :, 2]])
+    plt.close(flexFig.figure)
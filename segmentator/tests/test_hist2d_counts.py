@@ -0,0 +1,45 @@
+"""Test saving of 2D histogram counts without the GUI."""
+
+import numpy as np
+from segmentator.pipeline import pipeline_params
+from segmentator.hist2d_counts import hist2d_group, main
+from nibabel import save, Nifti1Image
+
+
+def test_hist2d_group():
+    """Test streamed group sums of differently sized histograms."""
+    # Given
+    counts = np.arange(9).reshape(3, 3)
+    group = hist2d_group()
+    # When
+    group.add(counts)
+    group.add(counts[:2, :2], d_min=1)
+    # Then
+    assert group.sum.shape == (3, 3)
+    assert group.sum[1, 1] == 4 + 0
+    assert group.sum[2, 2] == 8 + 4
+    assert np.allclose(group.mean(), group.sum / 2.)
+    assert np.isclose(group.log_mean()[2, 2],
+                      (np.log10(9) + np.log10(5)) / 2)
+
+
+def test_main(tmpdir):
+    """Test per subject and group counts of several images."""
+    # Given
+    filenames = []
+    for i in range(3):
+        data = np.random.random((8, 9, 10)).astype(np.float32)
+        filenames.append(str(tmpdir.join('sub-{}.nii'.format(i))))
+        save(Nifti1Image(data, np.eye(4)), filenames[-1])
+    params = pipeline_params(gramag='numpy', scale=50, use_cache=False)
+    # When
+    outNames = main(filenames, params, nr_processes=2)
+    # Then
+    counts = [np.load(outName + '.npy') for outName in sorted(outNames)]
+    group_sum = np.load(str(tmpdir.join(
+        'group_volHist_pcMax97pt5_pcMin2pt5_sc50_sum.npy')))
+    group_mean = np.load(str(tmpdir.join(
+        'group_volHist_pcMax97pt5_pcMin2pt5_sc50_mean.npy')))
+    assert len(outNames) == 3
+    assert np.array_equal(group_sum, np.sum(counts, axis=0))
+    assert np.allclose(group_mean, np.mean(counts, axis=0))
@@ -0,0 +1,54 @@
+"""Test the pipeline functions."""
+
+import numpy as np
+import pytest
+from segmentator.pipeline import pipeline_params, preprocess
+from segmentator.pipeline import map_selection, export_labels
+from nibabel import load, save, Nifti1Image
+
+
+def test_pipeline(tmpdir):
+    """Test repeated preprocessing and mapping without the GUI."""
+    # Given
+    data = np.random.random((10, 12, 14)).astype(np.float32)
+    data[:2] = 0
+    path = str(tmpdir.join('image.nii'))
+    save(Nifti1Image(data, np.eye(4)), path)
+    params = pipeline_params(gramag='numpy', scale=100, use_cache=False)
+    # When
+    volume = preprocess(path, params)
+    volume_scaled = preprocess(path, pipeline_params(
+        gramag='numpy', scale=50, use_cache=False))
+    volHistMask = np.zeros((volume.nr_bins, volume.nr_bins), dtype=bool)
+    volHistMask[:, 1:] = True  # [gradient, intensity], all but darkest
+    labels = map_selection(volume, volHistMask)
+    export_labels(volume, labels, str(tmpdir.join('labels.nii')))
+    # Then
+    assert volume.dims == data.shape
+    assert volume.counts.sum() <= np.count_nonzero(data)
+    assert volume.nr_bins == 100 and volume_scaled.nr_bins == 50
+    assert labels.dtype == np.uint8
+    assert not labels[:2].any()  # zeros are discarded
+    assert labels.sum() == volume.counts[1:].sum()
+    assert np.array_equal(load(str(tmpdir.join('labels.nii'))).dataobj,
+                          labels)
+    with pytest.raises(TypeError):
+        pipeline_params(nr_bins=10)
+
+
+def test_preprocess_counts_only(tmpdir):
+    """Test that counts-only preprocessing leaves the cache alone."""
+    # Given
+    data = np.random.random((10, 12, 14)).astype(np.float32)
+    path = str(tmpdir.join('image.nii'))
+    save(Nifti1Image(data, np.eye(4)), path)
+    cache_dir = tmpdir.mkdir('cache')
+    params = pipeline_params(gramag='numpy', scale=100, use_cache=True,
+                             cache_dir=str(cache_dir))
+    # When
+    volume = preprocess(path, params, index=False, write_cache=False)
+    cached = [f for f in cache_dir.visit() if f.ext == '.npy']
+    # Then
+    assert volume.binVoxels is None and volume.binOffsets is None
+    assert volume.counts.sum() > 0
+    assert cached == []
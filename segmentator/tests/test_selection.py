@@ -0,0 +1,53 @@
+"""Test selection files."""
+
+import numpy as np
+import segmentator.config as cfg
+import pytest
+from segmentator.pipeline import pipeline_params
+from segmentator.selection import save_selection, load_selection
+from segmentator.selection import use_selection_params
+
+
+class sector:
+    """Sector parameters as in gui_utils.sector_mask."""
+
+    cx, cy, radius, tmin, tmax = 10, 20, 30.5, 0, np.pi
+
+
+def test_selection(tmpdir):
+    """Test saving and loading of masks, labels and parameters."""
+    # Given
+    volHistMask = np.random.random((50, 50)) > 0.5
+    volHistLabels = np.random.randint(0, 5, (50, 50)).astype(np.uint8)
+    idxLasso = np.random.random(50 * 50) > 0.9
+    # When
+    path = save_selection(str(tmpdir.join('mask')), volHistMask, params=cfg,
+                          sector=sector, idxLasso=idxLasso)
+    mask, info = load_selection(path)
+    labels, info_labels = load_selection(
+        save_selection(str(tmpdir.join('labels.npz')), volHistLabels))
+    # Then
+    assert path.endswith('.npz')
+    assert mask.dtype == bool and np.array_equal(mask, volHistMask)
+    assert np.array_equal(info['idxLasso'], idxLasso)
+    assert info['sector'] == (10, 20, 30.5, 0, np.pi)
+    assert info['params']['scale'] == cfg.scale
+    assert np.isnan(info['params']['valmin'])
+    assert np.array_equal(labels, volHistLabels)
+    assert info_labels['params'] is None and info_labels['sector'] is None
+
+
+def test_use_selection_params():
+    """Test that gradient images of a selection are not reused."""
+    # Given
+    stored = dict(gramag='sobel', scale=300)
+    stored_image = dict(gramag='/data/sub-01_gramag.nii.gz', scale=300)
+    # When
+    params = use_selection_params(pipeline_params(), stored)
+    params_image = use_selection_params(pipeline_params(), stored_image,
+                                        gramag='scharr')
+    # Then
+    assert params.gramag == 'sobel' and params.scale == 300
+    assert params_image.gramag == 'scharr' and params_image.scale == 300
+    with pytest.raises(ValueError):
+        use_selection_params(pipeline_params(), stored_image)
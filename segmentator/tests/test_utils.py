@@ -2,6 +2,15 @@
 
 import numpy as np
 from segmentator.utils import truncate_range, scale_range
+from segmentator.utils import map_2D_hist_to_ima, map_2D_hist_to_vol
+from segmentator.utils import invert_ima_to_2D_hist_map, count_2D_hist_vox
+from segmentator.utils import remap_2D_hist_bins
+from segmentator.utils import prep_2D_hist, label_dtype, volume_stats
+from segmentator.utils import approximate_percentiles
+from segmentator.utils import create_3D_kernel, convolve_3D_kernel
+from segmentator.utils import compute_gradient_magnitude, load_data
+from nibabel import load, save, Nifti1Image
+from scipy.ndimage import convolve
 
 
 def test_truncate_range():
@@ -32,3 +41,210 @@ def test_scale_range():
     # Then
     assert all([np.nanmin(output) >= expected[0],
                 np.nanmax(output) < expected[1]])
+
+
+def test_map_2D_hist_to_ima():
+    """Test volume histogram to image mapping."""
+    # Given
+    nr_bins = 20
+    volHistMask = np.random.randint(0, 5, size=(nr_bins, nr_bins))
+    imaSlc2volHistMap = np.random.randint(0, nr_bins**2 + 10, size=(30, 40))
+    expected = np.zeros(imaSlc2volHistMap.shape)
+    for idx in np.unique(volHistMask):
+        linIndices = np.where(volHistMask.flatten() == idx)[0]
+        expected[np.isin(imaSlc2volHistMap, linIndices)] = idx
+    # When
+    output = map_2D_hist_to_ima(imaSlc2volHistMap, volHistMask)
+    # Then
+    assert np.array_equal(output, expected)
+
+
+def test_invert_ima_to_2D_hist_map():
+    """Test bin to voxel index against the voxel to bin map."""
+    # Given
+    nr_bins = 20
+    vox2pixMap = np.random.randint(0, nr_bins**2 + 10, size=(10, 12, 8))
+    volHistMask = np.random.randint(0, 5, size=(nr_bins, nr_bins))
+    expected = map_2D_hist_to_ima(vox2pixMap, volHistMask)
+    # When
+    binVoxels, binOffsets = invert_ima_to_2D_hist_map(vox2pixMap, nr_bins)
+    output = map_2D_hist_to_vol(binVoxels, binOffsets, volHistMask,
+                                vox2pixMap.shape)
+    # Then
+    assert binVoxels.dtype == np.uint32
+    assert np.array_equal(output, expected)
+    assert count_2D_hist_vox(binOffsets, volHistMask) == np.sum(expected > 0)
+
+
+def test_remap_2D_hist_bins():
+    """Test relabeling changed bins against a full remap."""
+    # Given
+    nr_bins = 20
+    vox2pixMap = np.random.randint(0, nr_bins**2 + 10, size=(10, 12, 8))
+    oldMask = np.random.randint(0, 5, size=(nr_bins, nr_bins))
+    newMask = oldMask.copy()
+    newMask[5:9, 2:14] = np.random.randint(0, 5, size=(4, 12))
+    binVoxels, binOffsets = invert_ima_to_2D_hist_map(vox2pixMap, nr_bins)
+    volMask = map_2D_hist_to_ima(vox2pixMap, oldMask)
+    sliceMask = np.transpose(volMask.copy(), (2, 0, 1))[:, :, 3]  # a view
+    slcVoxels, slcOffsets = invert_ima_to_2D_hist_map(
+        np.transpose(vox2pixMap, (2, 0, 1))[:, :, 3], nr_bins)
+    expected = map_2D_hist_to_ima(vox2pixMap, newMask)
+    # When
+    nr_voxels = remap_2D_hist_bins(volMask, binVoxels, binOffsets, newMask,
+                                   newMask != oldMask)
+    remap_2D_hist_bins(sliceMask, slcVoxels, slcOffsets, newMask,
+                       np.ones(newMask.shape, dtype=bool))
+    # Then
+    assert np.array_equal(volMask, expected)
+    assert np.array_equal(sliceMask, expected[:, 3, :].T)
+    assert nr_voxels == count_2D_hist_vox(binOffsets, newMask != oldMask)
+
+
+def test_prep_2D_hist():
+    """Test 2D histogram counts against numpy."""
+    # Given
+    ima = np.random.random(1000) * 50
+    gra = np.random.random(1000) * 60  # some values fall outside
+    ima[:10] = 0
+    ima[10] = 50  # right edge belongs to the last bin
+    # When
+    counts, d_min, d_max, nr_bins, bin_edges, vox2pixMap = prep_2D_hist(
+        ima, gra, discard_zeros=True)
+    # Then
+    expected, _, _ = np.histogram2d(ima[10:], gra[10:], bins=bin_edges)
+    assert counts.shape == (nr_bins, nr_bins)
+    assert np.array_equal(counts, expected)
+    assert vox2pixMap.dtype == np.uint32
+    assert vox2pixMap.size == ima.size
+
+
+def test_label_dtype():
+    """Test compact label data types."""
+    assert label_dtype(1) == np.uint8
+    assert label_dtype(255) == np.uint8
+    assert label_dtype(256) == np.uint16
+    assert label_dtype(2**16) == np.uint32
+
+
+def test_volume_stats():
+    """Test shared statistics and their use in truncation and scaling."""
+    # Given
+    data = np.random.random(1000) + 1.
+    data[np.random.choice(data.size, 100, replace=False)] = 0
+    data[np.random.choice(data.size, 5, replace=False)] = np.nan
+    expected = np.nanpercentile(data[~np.isclose(data, 0)], [5, 95])
+    # When
+    stats = volume_stats(data)
+    output, p_min, p_max = truncate_range(data, percMin=5, percMax=95,
+                                          stats=stats)
+    output = scale_range(output, scale_factor=10, stats=stats)
+    # Then
+    assert np.allclose([p_min, p_max], expected)
+    assert np.array_equal(stats.zero_mask, np.isclose(output, 0))
+    assert np.nanmax(output) == 10
+
+
+def test_volume_stats_truncated_extrema():
+    """Test that extrema with and without zeros follow truncation."""
+    # Given
+    data = np.random.random(1000) + 1.
+    data[np.random.choice(data.size, 100, replace=False)] = 0
+    data_max = data.max()
+    stats = volume_stats(data)
+    before = stats.min_max(False)  # cached before truncation
+    # When
+    output, p_min, p_max = truncate_range(data, percMin=5, percMax=95,
+                                          stats=stats)
+    # Then
+    assert before == (0, data_max) and data_max > p_max
+    assert stats.min_max(False) == (0, output.max())
+    assert np.allclose(stats.min_max(True), (p_min, p_max))
+
+
+def test_approximate_percentiles():
+    """Test approximate percentiles against their reported rank error."""
+    # Given
+    data = np.random.normal(size=(20, 30, 40))
+    data[0, ...] = 0
+    data[1, 1, :5] = np.nan
+    q = [2.5, 50, 97.5]
+    values = data[~np.isnan(data) & ~np.isclose(data, 0)]
+    # When
+    output, rank_error = approximate_percentiles(data, q, nr_bins=1000)
+    # Then
+    ranks = [100. * np.mean(values < v) for v in output]
+    assert np.all(np.abs(np.subtract(ranks, q)) <= rank_error + 100./values.size)
+
+
+def test_convolve_3D_kernel():
+    """Test separable convolution against full 3D convolution."""
+    # Given
+    data = np.random.random((10, 12, 14)).astype(np.float32)
+    sobel = create_3D_kernel('sobel')[1, ...]
+    custom = np.random.random((3, 3, 3))  # not separable
+    # When
+    output_sobel = convolve_3D_kernel(data, sobel)
+    output_custom = convolve_3D_kernel(data, custom)
+    # Then
+    assert output_sobel.dtype == np.float32
+    assert np.allclose(output_sobel, convolve(data, sobel), atol=1e-6)
+    assert np.allclose(output_custom, convolve(data, custom), atol=1e-6)
+
+
+def test_compute_gradient_magnitude_workers():
+    """Test that slab-wise gradients do not depend on the number of slabs."""
+    # Given
+    data = np.random.random((23, 12, 14)).astype(np.float32)
+    # When
+    outputs = [compute_gradient_magnitude(data, method, nr_workers=n)
+               for method in ['scharr', 'numpy'] for n in [1, 4]]
+    # Then
+    assert np.array_equal(outputs[0], outputs[1])
+    assert np.array_equal(outputs[2], outputs[3])
+
+
+def test_deriche_gradient_magnitude():
+    """Test that Deriche gradient magnitude peaks at a step edge."""
+    # Given
+    data = np.zeros((20, 21, 22), dtype=np.float32)
+    data[:, :, 11:] = 1
+    # When
+    output = compute_gradient_magnitude(data, 'deriche')
+    # Then
+    assert output.dtype == np.float32
+    assert np.argmax(output[10, 10, 3:-3]) + 3 in [10, 11]
+    assert np.isclose(output.max(), data.max())
+
+
+def test_deriche_3D_axis():
+    """Test Deriche derivatives along an axis against transposed input."""
+    from segmentator.deriche_3D import deriche_3D
+    # Given
+    data = np.random.random((8, 9, 10)).astype(np.float32)
+    data_t = np.ascontiguousarray(np.transpose(data, (1, 0, 2)))
+    out = np.empty(data.shape, dtype=np.float32)
+    # When
+    output = deriche_3D(data, alpha=2., axis=1, out=out)
+    expected = np.transpose(deriche_3D(data_t, alpha=2., axis=0), (1, 0, 2))
+    # Then
+    assert output is out
+    assert np.allclose(output, expected, atol=1e-5)
+
+
+def test_load_data(tmpdir):
+    """Test memory-mapped loading in the working data type."""
+    # Given
+    data = np.arange(24, dtype=np.int16).reshape(2, 3, 4, 1)
+    path = str(tmpdir.join('image.nii'))
+    save(Nifti1Image(data, np.eye(4)), path)
+    # When
+    output, dims = load_data(load(path))
+    output_orig, _ = load_data(load(path), force_original_precision=True)
+    output_orig[...] = 0
+    # Then
+    assert dims == (2, 3, 4)
+    assert output.dtype == np.float32
+    assert output_orig.dtype == np.int16
+    assert np.array_equal(output, data[..., 0])
+    assert np.array_equal(load(path).dataobj, data)
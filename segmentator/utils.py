@@ -4,11 +4,13 @@
 from __future__ import division, print_function
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 import segmentator.config as cfg
+from segmentator.cache_utils import get_cache, gradient_key
 from nibabel import load, Nifti1Image, save
-from scipy.ndimage import convolve
+from scipy.ndimage import convolve, convolve1d
 from time import time
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 
 def sub2ind(array_shape, rows, cols):
@@ -29,34 +31,67 @@ def sub2ind(array_shape, rows, cols):
     return (cols*array_shape + rows)
 
 
-def map_ima_to_2D_hist(xinput, yinput, bins_arr):
+def map_ima_to_2D_hist(xinput, yinput, bins_arr, out=None,
+                       chunk_size=2**20):
     """Image to volume histogram mapping (kind of inverse histogram).
 
     Parameters
     ----------
-    xinput : TODO
+    xinput : np.ndarray
         First image, which is often the intensity image (eg. T1w).
-    yinput : TODO
+    yinput : np.ndarray
         Second image, which is often the gradient magnitude image
         derived from the first image.
-    bins_arr : TODO
-        Array of bins.
+    bins_arr : np.ndarray
+        Array of evenly spaced bin edges.
+    out : 1D numpy array, optional
+        Preallocated output with one element per voxel.
+    chunk_size : integer
+        Number of voxels that are binned at once. Limits temporary memory.
 
     Returns
     -------
-    vox2pixMap : TODO
-        Voxel to pixel mapping.
+    vox2pixMap : 1D numpy array
+        Voxel to pixel mapping (uint32 unless the histogram is very large).
+        Voxels outside of the histogram are mapped to nr_bins*nr_bins.
+
+    Notes
+    -----
+    Bins are computed with floor arithmetic instead of a binary search in
+    the bin edges. Same as numpy histograms, the last bin includes its right
+    edge.
 
     """
-    dgtzData = np.digitize(xinput, bins_arr)-1
-    dgtzGra = np.digitize(yinput, bins_arr)-1
+    xinput, yinput = np.ravel(xinput), np.ravel(yinput)
     nr_bins = len(bins_arr)-1  # subtract 1 (more borders than containers)
-    vox2pixMap = sub2ind(nr_bins, dgtzData, dgtzGra)  # 1D
-    return vox2pixMap
+    nr_pix = nr_bins * nr_bins
+    b_min = float(bins_arr[0])
+    b_width = float(bins_arr[-1] - bins_arr[0]) / nr_bins
+    if out is None:
+        out = np.empty(xinput.size,
+                       dtype=np.uint32 if nr_pix < 2**32 else np.uint64)
+    # linear indices must be exact in the floating point type
+    ftype = np.float32 if nr_pix < 2**24 else np.float64
+    for i in range(0, xinput.size, chunk_size):
+        dgtzData = np.subtract(xinput[i:i+chunk_size], b_min, dtype=ftype)
+        dgtzGra = np.subtract(yinput[i:i+chunk_size], b_min, dtype=ftype)
+        if b_width != 1:
+            dgtzData /= b_width
+            dgtzGra /= b_width
+        inside = ((dgtzData >= 0) & (dgtzData <= nr_bins)
+                  & (dgtzGra >= 0) & (dgtzGra <= nr_bins))
+        for dgtz in (dgtzData, dgtzGra):
+            np.floor(dgtz, out=dgtz)
+            np.minimum(dgtz, nr_bins - 1, out=dgtz)  # right edge
+        vox2pixMap = sub2ind(nr_bins, dgtzData, dgtzGra)
+        # voxels outside of the histogram are put one past the last bin
+        vox2pixMap[~inside] = nr_pix
+        out[i:i+chunk_size] = vox2pixMap
+    return out
 
 
 def map_2D_hist_to_ima(imaSlc2volHistMap, volHistMask):
-    """Volume histogram to image mapping for slices (uses np.ind1).
+    """Volume histogram to image mapping for slices (uses a lookup table).
 
     Parameters
     ----------
@@ -69,32 +104,362 @@ def map_2D_hist_to_ima(imaSlc2volHistMap, volHistMask):
     -------
     imaSlcMask : 1D numpy array
         Flat image slice mask based on labeled pixels in volume histogram.
+        Has the data type of the volume histogram mask (uint8 for boolean
+        masks).
+
+    Notes
+    -----
+    The flattened volume histogram mask is used as a label lookup table which
+    is indexed with the linear bin indices in a single gather. Bin indices
+    that fall outside of the volume histogram are labeled with 0.
 
     """
-    imaSlcMask = np.zeros(imaSlc2volHistMap.shape)
-    idxUnique = np.unique(volHistMask)
-    for idx in idxUnique:
-        linIndices = np.where(volHistMask.flatten() == idx)[0]
-        # return logical array with length equal to nr of voxels
-        voxMask = np.in1d(imaSlc2volHistMap, linIndices)
-        # reset mask and apply logical indexing
-        imaSlcMask[voxMask] = idx
+    lut = np.ravel(volHistMask)
+    imaSlcMask = np.zeros(imaSlc2volHistMap.shape,
+                          dtype=np.uint8 if lut.dtype == bool else lut.dtype)
+    inside = (imaSlc2volHistMap >= 0) & (imaSlc2volHistMap < lut.size)
+    if inside.all():
+        imaSlcMask[...] = lut[imaSlc2volHistMap]
+    else:
+        imaSlcMask[inside] = lut[imaSlc2volHistMap[inside]]
     return imaSlcMask
 
 
-def truncate_range(data, percMin=0.25, percMax=99.75, discard_zeros=True):
+def invert_ima_to_2D_hist_map(vox2pixMap, nr_bins):
+    """Volume histogram bin to voxel index (inverse of the voxel to bin map).
+
+    Parameters
+    ----------
+    vox2pixMap : np.ndarray
+        Linear volume histogram bin index of every voxel.
+    nr_bins : integer
+        Number of one dimensional bins (not the pixels).
+
+    Returns
+    -------
+    binVoxels : 1D numpy array
+        Linear voxel indices sorted by their volume histogram bin.
+    binOffsets : 1D numpy array
+        Offset pointers (compressed sparse row style). Voxels that fall into
+        bin b are binVoxels[binOffsets[b]:binOffsets[b+1]].
+
+    Notes
+    -----
+    Voxels that fall outside of the volume histogram are left out.
+
+    """
+    vox2pixMap = np.ravel(vox2pixMap)
+    nr_pix = nr_bins * nr_bins
+    idx_dtype = np.uint32 if vox2pixMap.size < 2**32 else np.int64
+    # put voxels outside of the histogram into an extra last bin
+    outside = (vox2pixMap < 0) | (vox2pixMap >= nr_pix)
+    if outside.any():
+        vox2pixMap = np.where(outside, nr_pix, vox2pixMap)
+    binCounts = np.bincount(vox2pixMap, minlength=nr_pix+1)[:nr_pix]
+    binOffsets = np.zeros(nr_pix + 1, dtype=idx_dtype)
+    binOffsets[1:] = np.cumsum(binCounts)
+    binVoxels = np.argsort(vox2pixMap, kind='stable')[:binOffsets[-1]]
+    return binVoxels.astype(idx_dtype), binOffsets
+
+
+def map_2D_hist_to_vox(binVoxels, binOffsets, volHistMask):
+    """Find the voxels that fall into the selected volume histogram bins.
+
+    Parameters
+    ----------
+    binVoxels : 1D numpy array
+        Linear voxel indices sorted by bin, see invert_ima_to_2D_hist_map.
+    binOffsets : 1D numpy array
+        Offset pointers, see invert_ima_to_2D_hist_map.
+    volHistMask : np.ndarray
+        Volume histogram mask. Non-zero bins are selected.
+
+    Returns
+    -------
+    voxels : 1D numpy array
+        Linear voxel indices of the selected voxels.
+
+    """
+    bins = np.flatnonzero(volHistMask)
+    starts = binOffsets[bins].astype(np.int64)
+    lengths = binOffsets[bins + 1] - starts
+    # positions in binVoxels, gathered range by range without a python loop
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    positions += np.arange(positions.size)
+    return binVoxels[positions]
+
+
+def count_2D_hist_vox(binOffsets, volHistMask):
+    """Count the voxels that fall into the selected volume histogram bins."""
+    binCounts = np.diff(binOffsets)
+    return int(np.sum(binCounts[np.ravel(volHistMask) != 0]))
+
+
+def map_2D_hist_to_vol(binVoxels, binOffsets, volHistMask, shape,
+                       dtype=np.uint8):
+    """Volume histogram to image mapping for volumes (uses the bin index).
+
+    Parameters
+    ----------
+    binVoxels : 1D numpy array
+        Linear voxel indices sorted by bin, see invert_ima_to_2D_hist_map.
+    binOffsets : 1D numpy array
+        Offset pointers, see invert_ima_to_2D_hist_map.
+    volHistMask : np.ndarray
+        Labeled volume histogram mask.
+    shape : tuple
+        Shape of the volume that the bin index is created from.
+    dtype : numpy dtype
+        Data type of the labeled volume, see label_dtype.
+
+    Returns
+    -------
+    volMask : np.ndarray
+        Labeled volume. Only voxels in non-zero bins are visited.
+
+    """
+    lut = np.ravel(volHistMask)
+    bins = np.flatnonzero(lut)
+    lengths = np.diff(binOffsets)[bins]
+    voxels = map_2D_hist_to_vox(binVoxels, binOffsets, lut)
+    volMask = np.zeros(shape, dtype=dtype)
+    volMask.flat[voxels] = np.repeat(lut[bins], lengths)
+    return volMask
+
+
+def remap_2D_hist_bins(volMask, binVoxels, binOffsets, volHistMask,
+                       binChanged):
+    """Relabel the voxels of changed volume histogram bins in place.
+
+    Parameters
+    ----------
+    volMask : np.ndarray
+        Labeled volume or slice that the bin index is created from. Can be a
+        view, its voxels are addressed in C order.
+    binVoxels : 1D numpy array
+        Linear voxel indices sorted by bin, see invert_ima_to_2D_hist_map.
+    binOffsets : 1D numpy array
+        Offset pointers, see invert_ima_to_2D_hist_map.
+    volHistMask : np.ndarray
+        Labeled volume histogram mask, the new labels of the bins.
+    binChanged : np.ndarray
+        Bins whose label changed. Only their voxels are visited.
+
+    Returns
+    -------
+    nr_voxels : integer
+        Number of relabeled voxels.
+
+    """
+    binChanged = np.ravel(binChanged) != 0
+    voxels = map_2D_hist_to_vox(binVoxels, binOffsets, binChanged)
+    voxelBins = np.repeat(np.flatnonzero(binChanged),
+                          np.diff(binOffsets)[binChanged])
+    volMask.flat[voxels] = np.ravel(volHistMask)[voxelBins]
+    return voxels.size
+
+
+def label_dtype(max_label):
+    """Smallest unsigned integer data type that can hold the labels.
+
+    Parameters
+    ----------
+    max_label : integer
+        Largest label value.
+
+    Returns
+    -------
+    dtype : numpy dtype
+        One of uint8, uint16, uint32 or uint64.
+
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def relabel_2D_hist_mask(volHistMask, discard_zeros=True):
+    """Assign ascending integer labels to a volume histogram mask.
+
+    Parameters
+    ----------
+    volHistMask : np.ndarray, 2D
+        Volume histogram mask, e.g. a binary sector mask or ncut labels.
+    discard_zeros : bool
+        Leave out voxels in bin 0 (image zeros).
+
+    Returns
+    -------
+    labels : np.ndarray, 2D
+        Labels from 0 in the smallest data type that can hold them.
+
+    """
+    _, intLabels = np.unique(volHistMask, return_inverse=True)
+    labels = intLabels.reshape(np.shape(volHistMask)).astype(
+        label_dtype(intLabels.max()))
+    if discard_zeros:
+        labels.flat[0] = 0  # voxels in bin 0 are left out
+    return labels
+
+
+class volume_stats:
+    """Intensity statistics that are shared by the preprocessing steps.
+
+    Masks and extrema are computed once per volume. Functions that modify
+    the data in place (truncate_range, scale_range) keep them up to date, so
+    that the following steps do not need to recompute them.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image data, which is often the intensity image (eg. T1w).
+
+    """
+
+    def __init__(self, data):
+        """Initialize masks."""
+        self.data = data
+        self.nan_mask = np.isnan(data)
+        self.zero_mask = np.empty(data.shape, dtype=bool)
+        self.update_zero_mask()
+
+    def update_zero_mask(self, atol=1e-8):
+        """Find voxels with value 0 (same as np.isclose(data, 0))."""
+        np.less_equal(self.data, atol, out=self.zero_mask)
+        self.zero_mask &= self.data >= -atol
+        self.extrema = dict()  # min and max, keyed by discard_zeros
+
+    def valid_mask(self, discard_zeros=True):
+        """Voxels that are not NaN (and not 0 if discard_zeros)."""
+        if discard_zeros:
+            return ~(self.nan_mask | self.zero_mask)
+        else:
+            return ~self.nan_mask
+
+    def percentiles(self, q, discard_zeros=True):
+        """Percentiles of valid voxels (partitions a single copy)."""
+        values = self.data[self.valid_mask(discard_zeros)]
+        return np.percentile(values, q, overwrite_input=True)
+
+    def min_max(self, discard_zeros=True):
+        """Minimum and maximum of valid voxels."""
+        if discard_zeros not in self.extrema:
+            valid = self.valid_mask(discard_zeros)
+            self.extrema[discard_zeros] = (
+                np.min(self.data, where=valid, initial=np.inf),
+                np.max(self.data, where=valid, initial=-np.inf))
+        return self.extrema[discard_zeros]
+
+
+def read_slabs(dataobj, slab_size=8):
+    """Read an array slab by slab along its last non-singleton axis.
+
+    Parameters
+    ----------
+    dataobj : np.ndarray or nibabel array proxy
+        Data to be read. Array proxies (e.g. nii.dataobj) only read the
+        requested slab from the file.
+    slab_size : integer
+        Number of slices in each slab.
+
+    Yields
+    ------
+    index : tuple
+        Index of the slab in the squeezed array.
+    slab : np.ndarray
+        Squeezed slab.
+
+    """
+    shape = dataobj.shape
+    axis = max([i for i, n in enumerate(shape) if n > 1] + [0])
+    sq_axis = len([n for n in shape[:axis] if n > 1])
+    for i in range(0, shape[axis], slab_size):
+        sl = slice(i, min(i + slab_size, shape[axis]))
+        slab = np.asarray(dataobj[(slice(None),) * axis + (sl,)])
+        slab = slab.reshape([n for k, n in enumerate(slab.shape)
+                             if shape[k] > 1 or k == axis])
+        yield (slice(None),) * sq_axis + (sl,), slab
+
+
+def approximate_percentiles(data, q, discard_zeros=True, nr_bins=2**16,
+                            slab_size=8):
+    """Approximate percentiles from a fine histogram built slab by slab.
+
+    Parameters
+    ----------
+    data : np.ndarray or nibabel array proxy
+        Image data. Does not need to fit in memory (see read_slabs).
+    q : float or list of floats
+        Percentiles, between 0 and 100.
+    discard_zeros : bool
+        Discard voxels with value 0.
+    nr_bins : integer
+        Number of histogram bins. More bins give smaller errors.
+    slab_size : integer
+        Number of slices read at once.
+
+    Returns
+    -------
+    values : np.ndarray
+        Approximate percentiles.
+    rank_error : float
+        Upper bound of the rank error in percentile units, i.e. the true
+        percentile rank of each value is within q +/- rank_error.
+
+    Notes
+    -----
+    The data is read twice, first for the range and then for the counts.
+    Values are interpolated linearly within a bin.
+
+    """
+    def valid_values(slab):
+        valid = ~np.isnan(slab)
+        if discard_zeros:
+            valid &= ~np.isclose(slab, 0)
+        return slab[valid]
+
+    d_min, d_max = np.inf, -np.inf
+    for _, slab in read_slabs(data, slab_size):
+        values = valid_values(slab)
+        if values.size > 0:
+            d_min, d_max = min(d_min, values.min()), max(d_max, values.max())
+    counts = np.zeros(nr_bins, dtype=np.int64)
+    for _, slab in read_slabs(data, slab_size):
+        counts += np.histogram(valid_values(slab), bins=nr_bins,
+                               range=(d_min, d_max))[0]
+    nr_vox = counts.sum()
+    cum_counts = np.cumsum(counts)
+    # ranks as in linear interpolation of sorted values
+    ranks = np.asarray(q, dtype=np.float64) / 100. * (nr_vox - 1)
+    bins = np.minimum(np.searchsorted(cum_counts, ranks, side='right'),
+                      nr_bins - 1)
+    fraction = (ranks - cum_counts[bins] + counts[bins]) / counts[bins]
+    bin_width = (d_max - d_min) / nr_bins
+    values = d_min + (bins + np.clip(fraction, 0, 1)) * bin_width
+    rank_error = 100. * np.max(counts[bins]) / nr_vox
+    return values, rank_error
+
+
+def truncate_range(data, percMin=0.25, percMax=99.75, discard_zeros=True,
+                   stats=None, approximate=False):
     """Truncate too low and too high values.
 
     Parameters
     ----------
     data : np.ndarray
-        Image to be truncated.
+        Image to be truncated. Modified in place.
     percMin : float
         Percentile minimum.
     percMax : float
         Percentile maximum.
     discard_zeros : bool
         Discard voxels with value 0 from truncation.
+    stats : volume_stats, optional
+        Statistics of data. Computed here if not given.
+    approximate : bool
+        Use approximate percentiles (see approximate_percentiles) instead of
+        sorting a copy of the data.
 
     Returns
     -------
@@ -106,26 +471,37 @@ def truncate_range(data, percMin=0.25, percMax=99.75, discard_zeros=True):
         Maximum truncation threshold which is used.
 
     """
-    if discard_zeros:
-        msk = ~np.isclose(data, 0.)
-        pMin, pMax = np.nanpercentile(data[msk], [percMin, percMax])
+    if stats is None:
+        stats = volume_stats(data)
+    if approximate:
+        (pMin, pMax), rank_error = approximate_percentiles(
+            data, [percMin, percMax], discard_zeros=discard_zeros)
+        print('  Approximate percentiles, rank error <= {:.3g}'.format(
+            rank_error))
     else:
-        pMin, pMax = np.nanpercentile(data, [percMin, percMax])
-    temp = data[~np.isnan(data)]
-    temp[temp < pMin], temp[temp > pMax] = pMin, pMax  # truncate min and max
-    data[~np.isnan(data)] = temp
+        pMin, pMax = stats.percentiles([percMin, percMax], discard_zeros)
+    # truncate min and max, NaNs stay NaN
+    np.clip(data, pMin, pMax, out=data, casting='unsafe')
     if discard_zeros:
-        data[~msk] = 0  # put back masked out voxels
+        data[stats.zero_mask] = 0  # put back masked out voxels
+    else:
+        stats.update_zero_mask()
+    # thresholds as stored in data are the new extrema, extrema with zeros
+    # are recomputed when needed
+    stats.extrema.pop(not discard_zeros, None)
+    stats.extrema[discard_zeros] = (data.dtype.type(pMin),
+                                    data.dtype.type(pMax))
     return data, pMin, pMax
 
 
-def scale_range(data, scale_factor=500, delta=0, discard_zeros=True):
+def scale_range(data, scale_factor=500, delta=0, discard_zeros=True,
+                stats=None):
     """Scale values as a preprocessing step.
 
     Parameters
     ----------
     data : np.ndarray
-        Image to be scaled.
+        Image to be scaled. Modified in place.
     scale_factor : float
         Lower scaleFactors provides faster interface due to loweing the
         resolution of 2D histogram ( 500 seems fast enough).
@@ -134,6 +510,8 @@ def scale_range(data, scale_factor=500, delta=0, discard_zeros=True):
         when this function is used with histograms.
     discard_zeros : bool
         Discard voxels with value 0 from truncation.
+    stats : volume_stats, optional
+        Statistics of data. Computed here if not given.
 
     Returns
     -------
@@ -141,18 +519,78 @@ def scale_range(data, scale_factor=500, delta=0, discard_zeros=True):
         Scaled image.
 
     """
-    if discard_zeros:
-        msk = ~np.isclose(data, 0)
-    else:
-        msk = np.ones(data.shape, dtype=bool)
+    if stats is None:
+        stats = volume_stats(data)
+    d_min, d_max = stats.min_max(discard_zeros)
+    msk = ~stats.zero_mask if discard_zeros else True
     scale_factor = scale_factor - delta
-    data[msk] = data[msk] - np.nanmin(data[msk])
-    data[msk] = scale_factor / np.nanmax(data[msk]) * data[msk]
+    np.subtract(data, d_min, out=data, where=msk, casting='unsafe')
+    np.multiply(data, scale_factor / (d_max - d_min), out=data, where=msk,
+                casting='unsafe')
     if discard_zeros:
-        data[~msk] = 0  # put back masked out voxels
+        data[stats.zero_mask] = 0  # put back masked out voxels
+    # minimum became zero
+    stats.update_zero_mask()
     return data
 
 
+def truncate_and_scale(dataobj, percMin=0.25, percMax=99.75,
+                       scale_factor=500, delta=0, discard_zeros=True,
+                       out=None, slab_size=8):
+    """Truncate and scale an image slab by slab (out of core).
+
+    Gives the same result as truncate_range followed by scale_range, but
+    uses approximate percentiles and reads the input slab by slab.
+
+    Parameters
+    ----------
+    dataobj : np.ndarray or nibabel array proxy
+        Image to be truncated and scaled (e.g. nii.dataobj).
+    percMin : float
+        Percentile minimum.
+    percMax : float
+        Percentile maximum.
+    scale_factor : float
+        See scale_range.
+    delta : float
+        See scale_range.
+    discard_zeros : bool
+        Discard voxels with value 0 from truncation and scaling.
+    out : np.ndarray, optional
+        Float output with the squeezed input shape, e.g. a np.memmap.
+    slab_size : integer
+        Number of slices read at once.
+
+    Returns
+    -------
+    out : np.ndarray
+        Truncated and scaled image.
+    pMin : float
+        Minimum truncation threshold which is used.
+    pMax : float
+        Maximum truncation threshold which is used.
+
+    """
+    (pMin, pMax), rank_error = approximate_percentiles(
+        dataobj, [percMin, percMax], discard_zeros=discard_zeros,
+        slab_size=slab_size)
+    print('  Approximate percentiles, rank error <= {:.3g}'.format(
+        rank_error))
+    if out is None:
+        out = np.empty([n for n in dataobj.shape if n > 1], dtype=np.float32)
+    scale_factor = scale_factor - delta
+    for index, slab in read_slabs(dataobj, slab_size):
+        slab = slab.astype(out.dtype)
+        zeros = np.isclose(slab, 0)
+        np.clip(slab, pMin, pMax, out=slab)
+        slab -= pMin
+        slab *= scale_factor / (pMax - pMin)
+        if discard_zeros:
+            slab[zeros] = 0  # put back masked out voxels
+        out[index] = slab
+    return out, pMin, pMax
+
+
 def check_data(data, force_original_precision=True):
     """Do type casting here."""
     data = np.squeeze(data)  # to prevent singular dimension error
@@ -166,7 +604,41 @@ def check_data(data, force_original_precision=True):
     return data, dims
 
 
-def prep_2D_hist(ima, gra, discard_zeros=True):
+def load_data(nii, force_original_precision=False):
+    """Load image data from a nibabel image with a single conversion.
+
+    Uncompressed images are memory-mapped copy-on-write, voxels are only
+    read when they are used and in place preprocessing does not change the
+    file. Compressed images are decompressed once, directly in the target
+    data type.
+
+    Parameters
+    ----------
+    nii : nibabel image
+        Input image, loaded with nibabel.load.
+    force_original_precision : bool
+        Keep the data type of the file instead of casting to float32.
+
+    Returns
+    -------
+    data : np.ndarray
+        Image data without singular dimensions.
+    dims : tuple
+        Shape of data.
+
+    """
+    print('Input image data type is {}.'.format(nii.get_data_dtype().name))
+    if force_original_precision:
+        data = np.asanyarray(nii.dataobj)
+    else:
+        data = nii.get_fdata(dtype=np.float32, caching='unchanged')
+        if nii.get_data_dtype() != data.dtype:
+            print('  Data type is casted to {}.'.format(data.dtype.name))
+    data = np.squeeze(data)  # to prevent singular dimension error
+    return data, data.shape
+
+
+def prep_2D_hist(ima, gra, discard_zeros=True, stats=None):
     """Prepare 2D histogram related variables.
 
     Parameters
@@ -176,11 +648,15 @@ def prep_2D_hist(ima, gra, discard_zeros=True):
     gra : np.ndarray
         Second image, which is often the gradient magnitude image
         derived from the first image.
+    discard_zeros : bool
+        Leave voxels with value 0 in the first image out of the counts.
+    stats : volume_stats, optional
+        Statistics of the first image. Computed here if not given.
 
     Returns
     -------
-    counts : integer
-    volHistH : TODO
+    counts : np.ndarray
+        2D histogram counts, indexed as [intensity bin, gradient bin].
     d_min : float
         Minimum of the first image.
     d_max : float
@@ -188,20 +664,30 @@ def prep_2D_hist(ima, gra, discard_zeros=True):
     nr_bins : integer
         Number of one dimensional bins (not the pixels).
     bin_edges : TODO
+    vox2pixMap : 1D numpy array
+        Voxel to pixel mapping of all voxels, see map_ima_to_2D_hist.
 
     Notes
     -----
-    This function is modularized to be called from the terminal.
+    This function is modularized to be called from the terminal. It does not
+    use matplotlib, see gui_utils.plot_2D_hist for drawing the counts.
 
     """
-    if discard_zeros:
-        gra = gra[~np.isclose(ima, 0)]
-        ima = ima[~np.isclose(ima, 0)]
-    d_min, d_max = np.round(np.nanpercentile(ima, [0, 100]))
+    if stats is None:
+        stats = volume_stats(ima)
+    ima, gra = np.ravel(ima), np.ravel(gra)
+    d_min, d_max = np.round(stats.min_max(discard_zeros))
     nr_bins = int(d_max - d_min)
     bin_edges = np.arange(d_min, d_max+1)
-    counts, _, _, volHistH = plt.hist2d(ima, gra, bins=bin_edges, cmap='Greys')
-    return counts, volHistH, d_min, d_max, nr_bins, bin_edges
+    vox2pixMap = map_ima_to_2D_hist(ima, gra, bin_edges)
+    # count binned voxels, zeros are left out if discard zeros
+    if discard_zeros:
+        vox2pixMap_nonzero = vox2pixMap[~np.ravel(stats.zero_mask)]
+    else:
+        vox2pixMap_nonzero = vox2pixMap
+    counts = np.bincount(vox2pixMap_nonzero, minlength=nr_bins*nr_bins+1)
+    counts = counts[:nr_bins*nr_bins].reshape(nr_bins, nr_bins).T
+    return counts, d_min, d_max, nr_bins, bin_edges, vox2pixMap
 
 
 def create_3D_kernel(operator='scharr'):
@@ -217,21 +703,23 @@ def create_3D_kernel(operator='scharr'):
     kernel : np.ndarray, shape(6, n, n, 3)
 
     """
-    if operator == 'sobel':
-        operator = np.array([[[1, 2, 1], [2, 4, 2], [1, 2, 1]],
-                             [[0, 0, 0], [0, 0, 0], [0, 0, 0]],
-                             [[-1, -2, -1], [-2, -4, -2], [-1, -2, -1]]],
-                            dtype='float32')
-    elif operator == 'prewitt':
-        operator = np.array([[[1, 1, 1], [1, 1, 1], [1, 1, 1]],
-                             [[0, 0, 0], [0, 0, 0], [0, 0, 0]],
-                             [[-1, -1, -1], [-1, -1, -1], [-1, -1, -1]]],
-                            dtype='float32')
-    elif operator == 'scharr':
-        operator = np.array([[[9, 30, 9], [30, 100, 30], [9, 30, 9]],
-                             [[0, 0, 0], [0, 0, 0], [0, 0, 0]],
-                             [[-9, -30, -9], [-30, -100, -30], [-9, -30, -9]]],
-                            dtype='float32')
+    if isinstance(operator, str):
+        if operator.lower() == 'sobel':
+            operator = np.array([[[1, 2, 1], [2, 4, 2], [1, 2, 1]],
+                                 [[0, 0, 0], [0, 0, 0], [0, 0, 0]],
+                                 [[-1, -2, -1], [-2, -4, -2], [-1, -2, -1]]],
+                                dtype='float32')
+        elif operator.lower() == 'prewitt':
+            operator = np.array([[[1, 1, 1], [1, 1, 1], [1, 1, 1]],
+                                 [[0, 0, 0], [0, 0, 0], [0, 0, 0]],
+                                 [[-1, -1, -1], [-1, -1, -1], [-1, -1, -1]]],
+                                dtype='float32')
+        elif operator.lower() == 'scharr':
+            operator = np.array([[[9, 30, 9], [30, 100, 30], [9, 30, 9]],
+                                 [[0, 0, 0], [0, 0, 0], [0, 0, 0]],
+                                 [[-9, -30, -9], [-30, -100, -30],
+                                  [-9, -30, -9]]],
+                                dtype='float32')
     scale_normalization_factor = np.sum(np.abs(operator))
     operator = np.divide(operator, scale_normalization_factor)
 
@@ -243,16 +731,215 @@ def create_3D_kernel(operator='scharr'):
     return kernel
 
 
-def compute_gradient_magnitude(ima, method='scharr'):
+def separate_3D_kernel(kernel, rtol=1e-6):
+    """Split a 3D kernel into one 1D kernel per axis.
+
+    Parameters
+    ----------
+    kernel : np.ndarray, shape=(n, n, n)
+        3D kernel, for example one permutation from `create_3D_kernel`.
+    rtol : float
+        Relative tolerance for accepting the kernel as separable.
+
+    Returns
+    -------
+    factors : list of np.ndarray or None
+        1D kernels whose outer product is the input kernel. None if the
+        kernel is not separable.
+
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    norm = np.abs(kernel).max()
+    if kernel.ndim != 3 or norm == 0:
+        return None
+    factors = []
+    rest = kernel
+    for axis in range(kernel.ndim - 1):
+        # rank-1 factorization of the kernel unfolded along this axis
+        u, s, vt = np.linalg.svd(rest.reshape(rest.shape[0], -1),
+                                 full_matrices=False)
+        factors.append(u[:, 0] * s[0])
+        rest = vt[0].reshape(rest.shape[1:])
+    factors.append(rest)
+    product = factors[0][:, None, None] * factors[1][None, :, None] \
+        * factors[2][None, None, :]
+    if not np.allclose(product, kernel, rtol=0, atol=rtol * norm):
+        return None
+    return factors
+
+
+def convolve_3D_kernel(ima, kernel, output=None):
+    """Convolve image with a 3D kernel, as 1D passes when separable.
+
+    Parameters
+    ----------
+    ima : np.ndarray, 3D
+        Input image.
+    kernel : np.ndarray, shape=(n, n, n)
+        3D kernel.
+    output : np.ndarray, optional
+        Float32 array with the same shape as ima, to be filled in place.
+
+    Returns
+    -------
+    output : np.ndarray
+        Convolved image.
+
+    """
+    if output is None:
+        output = np.empty(ima.shape, dtype=np.float32)
+    factors = separate_3D_kernel(kernel)
+    if factors is None:
+        return convolve(ima, kernel, output=output)
+    convolve1d(ima, factors[0], axis=0, output=output)
+    for axis in range(1, ima.ndim):
+        # later passes run in place on the partial result
+        convolve1d(output, factors[axis], axis=axis, output=output)
+    return output
+
+
+def get_nr_workers(nr_workers=None):
+    """Resolve number of worker threads.
+
+    Parameters
+    ----------
+    nr_workers : int, optional
+        Requested number of workers. None uses the configured value, values
+        below 1 use all available cores.
+
+    Returns
+    -------
+    nr_workers : int
+
+    """
+    if nr_workers is None:
+        nr_workers = cfg.nr_workers
+    if nr_workers < 1:
+        nr_workers = cpu_count()
+    return int(nr_workers)
+
+
+def apply_on_slabs(func, ima, halo, nr_workers=None, out=None,
+                   dtype=np.float32):
+    """Apply a local filter slab by slab on a thread pool.
+
+    The image is split into slabs along the first axis. Each slab is
+    extended by `halo` planes on both sides (where available) so that the
+    filter output of the slab interior does not depend on the split.
+
+    Parameters
+    ----------
+    func : callable
+        Maps an array to an output array of the same shape. Has to be
+        local, i.e. an output voxel only depends on input voxels within
+        `halo` planes.
+    ima : np.ndarray
+        Input image.
+    halo : int
+        Half width of the filter support along the first axis.
+    nr_workers : int, optional
+        Number of worker threads (see `get_nr_workers`).
+    out : np.ndarray, optional
+        Preallocated output, filled in place.
+    dtype : np.dtype
+        Data type of the output if `out` is not given.
+
+    Returns
+    -------
+    out : np.ndarray
+        Filtered image.
+
+    """
+    nr_workers = get_nr_workers(nr_workers)
+    if out is None:
+        out = np.empty(ima.shape, dtype=dtype)
+    nr_planes = ima.shape[0]
+    # a few slabs per worker to balance load, not thinner than the halo
+    step = max(int(np.ceil(nr_planes / (2. * nr_workers))), 2 * halo, 1)
+    if nr_workers == 1 or step >= nr_planes:
+        out[...] = func(ima)
+        return out
+
+    def run(lo):
+        hi = min(lo + step, nr_planes)
+        lo_halo, hi_halo = max(lo - halo, 0), min(hi + halo, nr_planes)
+        result = func(ima[lo_halo:hi_halo])
+        out[lo:hi] = result[lo - lo_halo:hi - lo_halo]
+
+    pool = ThreadPool(nr_workers)
+    try:
+        pool.map(run, range(0, nr_planes, step))
+    finally:
+        pool.close()
+    return out
+
+
+def kernel_gradient_magnitude(ima, kernel):
+    """Compute gradient magnitude with permutations of a 3D kernel.
+
+    Parameters
+    ----------
+    ima : np.ndarray, 3D
+        Input image.
+    kernel : np.ndarray, shape(3, n, n, n)
+        Kernel permutations from `create_3D_kernel`.
+
+    Returns
+    -------
+    gra_mag : np.ndarray, float32
+
+    """
+    gra_mag = np.zeros(ima.shape, dtype=np.float32)
+    gra = np.empty(ima.shape, dtype=np.float32)
+    for d in range(kernel.shape[0]):
+        convolve_3D_kernel(ima, kernel[d, ...], output=gra)
+        np.multiply(gra, gra, out=gra)
+        gra_mag += gra
+    # compute generic gradient magnitude with normalization
+    gra_mag *= 2.
+    np.sqrt(gra_mag, out=gra_mag)
+    return gra_mag
+
+
+def numpy_gradient_magnitude(ima):
+    """Compute gradient magnitude with central differences.
+
+    Parameters
+    ----------
+    ima : np.ndarray
+        Input image.
+
+    Returns
+    -------
+    gra_mag : np.ndarray, float32
+
+    """
+    gra_mag = np.zeros(ima.shape, dtype=np.float32)
+    for d in range(ima.ndim):
+        gra = np.gradient(ima, axis=d)
+        gra_mag += np.multiply(gra, gra, out=gra)
+    np.sqrt(gra_mag, out=gra_mag)
+    return gra_mag
+
+
+def compute_gradient_magnitude(ima, method='scharr', stats=None,
+                               nr_workers=None, alpha=None):
     """Compute gradient magnitude of images.
 
     Parameters
     ----------
     ima : np.ndarray
         First image, which is often the intensity image (eg. T1w).
-    method : string
+    method : string or np.ndarray
         Gradient computation method. Available options are 'scharr',
-        'sobel', 'prewitt', 'numpy'.
+        'sobel', 'prewitt', 'numpy', 'deriche' or a custom 3D operator
+        (see `create_3D_kernel`).
+    stats : volume_stats, optional
+        Statistics of the first image. Used in 'deriche' normalization.
+    nr_workers : int, optional
+        Number of worker threads. Uses cfg.nr_workers if not given.
+    alpha : float, optional
+        Used in 'deriche' method. Uses cfg.deriche_alpha if not given.
     Returns
     -------
     gra_mag : np.ndarray
@@ -262,36 +949,32 @@ def compute_gradient_magnitude(ima, method='scharr'):
     """
     start = time()
     print('  Computing gradients...')
-    if method.lower() == 'sobel':  # magnitude scale is similar to numpy method
+    nr_workers = get_nr_workers(nr_workers)
+    if isinstance(method, str):
+        method = method.lower()
+    if isinstance(method, np.ndarray) or method in ['scharr', 'sobel',
+                                                     'prewitt']:
+        # magnitude scale is similar to numpy method
         kernel = create_3D_kernel(operator=method)
-        gra = np.zeros(ima.shape + (kernel.shape[0],))
-        for d in range(kernel.shape[0]):
-            gra[..., d] = convolve(ima, kernel[d, ...])
-        # compute generic gradient magnitude with normalization
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=-1) * 2.)
-    elif method.lower() == 'prewitt':
-        kernel = create_3D_kernel(operator=method)
-        gra = np.zeros(ima.shape + (kernel.shape[0],))
-        for d in range(kernel.shape[0]):
-            gra[..., d] = convolve(ima, kernel[d, ...])
-        # compute generic gradient magnitude with normalization
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=-1) * 2.)
-    elif method.lower() == 'scharr':
-        kernel = create_3D_kernel(operator=method)
-        gra = np.zeros(ima.shape + (kernel.shape[0],))
-        for d in range(kernel.shape[0]):
-            gra[..., d] = convolve(ima, kernel[d, ...])
-        # compute generic gradient magnitude with normalization
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=-1) * 2.)
-    elif method.lower() == 'numpy':
-        gra = np.asarray(np.gradient(ima))
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=0))
-    elif method.lower() == 'deriche':
+        halo = kernel.shape[1] // 2
+        gra_mag = apply_on_slabs(
+            lambda slab: kernel_gradient_magnitude(slab, kernel), ima,
+            halo=halo, nr_workers=nr_workers)
+    elif method == 'numpy':
+        gra_mag = apply_on_slabs(numpy_gradient_magnitude, ima, halo=1,
+                                 nr_workers=nr_workers)
+    elif method == 'deriche':
         from segmentator.deriche_prepare import Deriche_Gradient_Magnitude
-        alpha = cfg.deriche_alpha
+        alpha = cfg.deriche_alpha if alpha is None else alpha
         print('    Selected alpha: {}'.format(alpha))
+        if stats is None:
+            stats = volume_stats(ima)
         ima = np.ascontiguousarray(ima, dtype=np.float32)
-        gra_mag = Deriche_Gradient_Magnitude(ima, alpha, normalize=True)
+        # recursive filter has no finite halo, the kernel runs lines in
+        # parallel instead
+        gra_mag = Deriche_Gradient_Magnitude(
+            ima, alpha, normalize=True, ima_range=stats.min_max(False),
+            nr_workers=nr_workers)
     else:
         print('  Gradient magnitude method is invalid!')
     end = time()
@@ -300,7 +983,8 @@ def compute_gradient_magnitude(ima, method='scharr'):
     return gra_mag
 
 
-def set_gradient_magnitude(image, gramag_option):
+def set_gradient_magnitude(image, gramag_option, stats=None, key=None,
+                           params=None, write_cache=True):
     """Set gradient magnitude based on the command line flag.
 
     Parameters
@@ -309,6 +993,16 @@ def set_gradient_magnitude(image, gramag_option):
         First image, which is often the intensity image (eg. T1w).
     gramag_option : string
         A keyword string or a path to a nifti file.
+    stats : volume_stats, optional
+        Statistics of the first image.
+    key : str, optional
+        Cache key of the first image (see `cache_utils.preprocessing_key`).
+        Gradient magnitude is read from and written to the cache if given.
+    params : pipeline_params, optional
+        Parameter object. Uses segmentator.config if not given.
+    write_cache : bool
+        Store a computed gradient magnitude in the cache. Cached gradients
+        are read either way.
 
     Returns
     -------
@@ -316,29 +1010,45 @@ def set_gradient_magnitude(image, gramag_option):
         Gradient magnitude image, which has the same shape as image.
 
     """
-    if gramag_option not in cfg.gramag_options:
+    params = cfg if params is None else params
+    cache = get_cache(params) if key is not None else None
+    if cache is not None:
+        key = gradient_key(key, gramag_option, params)
+        gra_mag = cache.load(key)
+        if gra_mag is not None and gra_mag.shape == image.shape:
+            print('  Gradient magnitude is loaded from cache.')
+            return gra_mag
+
+    if gramag_option not in params.gramag_options:
         print("Selected gradient magnitude method is not available,"
               + " interpreting as a file path...")
-        gra_mag_nii = load(gramag_option)
-        gra_mag = np.squeeze(gra_mag_nii.get_data())
-        gra_mag, _ = check_data(gra_mag, cfg.force_original_precision)
-        gra_mag, _, _ = truncate_range(gra_mag, percMin=cfg.perc_min,
-                                       percMax=cfg.perc_max)
-        gra_mag = scale_range(gra_mag, scale_factor=cfg.scale, delta=0.0001)
+        gra_mag, _ = load_data(load(gramag_option),
+                               params.force_original_precision)
+        gra_stats = volume_stats(gra_mag)
+        gra_mag, _, _ = truncate_range(gra_mag, percMin=params.perc_min,
+                                       percMax=params.perc_max,
+                                       stats=gra_stats)
+        gra_mag = scale_range(gra_mag, scale_factor=params.scale,
+                              delta=0.0001, stats=gra_stats)
 
     else:
         print('{} gradient method is selected.'.format(gramag_option.title()))
-        gra_mag = compute_gradient_magnitude(image, method=gramag_option)
+        gra_mag = compute_gradient_magnitude(
+            image, method=gramag_option, stats=stats,
+            nr_workers=params.nr_workers, alpha=params.deriche_alpha)
+    if cache is not None and write_cache:
+        cache.save(key, np.asarray(gra_mag, dtype=np.float32))
     return gra_mag
 
 
-def export_gradient_magnitude_image(img, filename, filtername, affine):
+def export_gradient_magnitude_image(img, filename, filtername, affine,
+                                    alpha=None):
     """Export computed gradient magnitude image as a nifti file."""
     basename = filename.split(os.extsep, 1)[0]
     out_img = Nifti1Image(img, affine=affine)
     if filtername == 'deriche':  # add alpha as suffix for extra information
-        filtername = '{}_alpha{}'.format(filtername.title(),
-                                         cfg.deriche_alpha)
+        alpha = cfg.deriche_alpha if alpha is None else alpha
+        filtername = '{}_alpha{}'.format(filtername.title(), alpha)
         filtername = filtername.replace('.', 'pt')
     else:
         filtername = filtername.title()
@@ -8,11 +8,23 @@ To install for development, using the commandline do:
 from setuptools import setup
 from setuptools.extension import Extension
 from os.path import join
+import sys
 import numpy
 
+# OpenMP is used to filter lines in parallel in the Deriche kernel. Apple
+# clang ships without it, the kernel then runs on a single core.
+if sys.platform.startswith('win'):
+    openmp_compile_args, openmp_link_args = ['/openmp'], []
+elif sys.platform == 'darwin':
+    openmp_compile_args, openmp_link_args = [], []
+else:
+    openmp_compile_args, openmp_link_args = ['-fopenmp'], ['-fopenmp']
+
 ext_modules = [Extension(
     "segmentator.deriche_3D", [join('segmentator', 'cython', 'deriche_3D.c')],
-    include_dirs=[numpy.get_include()])
+    include_dirs=[numpy.get_include()],
+    extra_compile_args=openmp_compile_args,
+    extra_link_args=openmp_link_args)
     ]
 
 setup(name='segmentator',
@@ -31,6 +43,7 @@ setup(name='segmentator',
         'console_scripts': [
             'segmentator = segmentator.__main__:main',
             'segmentator_filters = segmentator.filters_ui:main',
+            'segmentator_batch = segmentator.batch_ui:main',
             ]},
       ext_modules=ext_modules,
       )